@@ -0,0 +1,253 @@
+"""
+Admission control for the generation endpoint.
+estimate_cost() works on the raw chart text with the same line rules as ChordProgression.from_string
+and the same section expansion as ChordProgression.__iter__, but without parsing a single chord,
+so oversized charts are rejected before they cost anything. RenderBudget bounds the work in flight across all worker processes.
+"""
+import asyncio
+import math
+import os
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+WAV_BYTES_PER_SECOND = 44100 * 2 * 2  # MuseScore renders 44.1 kHz stereo 16-bit
+RENDER_TAIL_SECONDS = 1.0  # release of the last notes after the final bar
+
+class AdmissionError(Exception):
+    """A request that must not be rendered now; status_code is the HTTP status to answer with."""
+    def __init__(self, status_code: int, message: str, retry_after: int | None = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+@dataclass
+class ChartCost:
+    quarters: int
+    bars: int
+    duration_s: float
+    output_bytes: int
+
+@dataclass
+class Limits:
+    max_chart_chars: int = 20_000
+    max_bars: int = 512
+    max_duration_s: float = 1200.0
+    max_output_bytes: int = 200 * 1024 * 1024
+    budget_bars: int = 1024  # expanded bars rendered at once by all workers together
+    max_queued: int = 16  # requests waiting for budget before new ones get 429
+    max_per_client: int = 0  # requests in flight or queued per client address, 0 = no limit
+    queue_timeout_s: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "Limits":
+        env = os.environ.get
+        return cls(
+            max_chart_chars=int(env("JAZZCOMP_MAX_CHART_CHARS", cls.max_chart_chars)),
+            max_bars=int(env("JAZZCOMP_MAX_BARS", cls.max_bars)),
+            max_duration_s=float(env("JAZZCOMP_MAX_DURATION_S", cls.max_duration_s)),
+            max_output_bytes=int(float(env("JAZZCOMP_MAX_OUTPUT_MB", cls.max_output_bytes / 1024 / 1024)) * 1024 * 1024),
+            budget_bars=int(env("JAZZCOMP_RENDER_BUDGET_BARS", cls.budget_bars)),
+            max_queued=int(env("JAZZCOMP_MAX_QUEUED", cls.max_queued)),
+            max_per_client=int(env("JAZZCOMP_MAX_PER_CLIENT", cls.max_per_client)),
+            queue_timeout_s=float(env("JAZZCOMP_QUEUE_TIMEOUT_S", cls.queue_timeout_s)),
+        )
+
+def _classify(line: str) -> tuple[str, str]:
+    """('skip' | 'definition' | 'reference' | 'event' | 'bar', section name) for one chart line."""
+    if not line or line.startswith("@"):
+        return "skip", ""
+    if line.startswith("#"):
+        # from_string keeps '#' lines as events, and an event that reads like a section marker acts as one
+        event = line[1:].strip()
+        if event.startswith("**"):
+            return "reference", event[2:].strip()
+        if event.startswith("*"):
+            return "definition", event[1:].strip()
+        return "event", ""
+    if line.startswith("**"):
+        return "reference", line[2:].strip()
+    if line.startswith("*"):
+        return "definition", line[1:].strip()
+    return "bar", ""
+
+def count_quarters(text: str, bar_length_quarters: int = 4) -> int:
+    """Quarters of the expanded progression, equal to summing durations over list(ChordProgression.from_string(text))."""
+    bar_length_quarters = max(bar_length_quarters, 1)
+    lines = [_classify(raw_line.strip()) for raw_line in text.splitlines()]
+    # one pass for section lengths: the first definition of a name wins and any definition ends the previous one
+    section_quarters: dict[str, int] = {}
+    current = None
+    for kind, name in lines:
+        if kind == "definition":
+            current = name if name not in section_quarters else None
+            if current is not None:
+                section_quarters[current] = 0
+        elif kind == "bar" and current is not None:
+            section_quarters[current] += bar_length_quarters
+    total = 0
+    for kind, name in lines:
+        if kind == "bar":
+            total += bar_length_quarters
+        elif kind == "reference":
+            total += section_quarters.get(name, 0)
+    return total
+
+def estimate_cost(text: str, tempo: int = 120, bar_length_quarters: int = 4) -> ChartCost:
+    quarters = count_quarters(text, bar_length_quarters)
+    bars = max(math.ceil(quarters / bar_length_quarters), 1)
+    duration_s = bars * bar_length_quarters * 60 / tempo + RENDER_TAIL_SECONDS
+    return ChartCost(quarters, bars, duration_s, int(duration_s * WAV_BYTES_PER_SECOND))
+
+def check_chart(text: str, limits: Limits, tempo: int = 120, bar_length_quarters: int = 4) -> ChartCost:
+    """Estimates the cost of a chart and raises AdmissionError(413) if any limit is exceeded."""
+    if len(text) > limits.max_chart_chars:
+        raise AdmissionError(413, f"Chart is {len(text)} characters long, the limit is {limits.max_chart_chars}.")
+    cost = estimate_cost(text, tempo, bar_length_quarters)
+    if cost.bars > limits.max_bars:
+        raise AdmissionError(413, f"Chart expands to {cost.bars} bars, the limit is {limits.max_bars}.")
+    if cost.duration_s > limits.max_duration_s:
+        raise AdmissionError(413, f"Chart would play for {cost.duration_s:.0f} s, the limit is {limits.max_duration_s:.0f} s.")
+    if cost.output_bytes > limits.max_output_bytes:
+        raise AdmissionError(413, f"Output would be {cost.output_bytes / 1024 / 1024:.1f} MB, "
+                                  f"the limit is {limits.max_output_bytes / 1024 / 1024:.1f} MB.")
+    return cost
+
+class RenderBudget:
+    """
+    Cost-weighted concurrency budget shared by every worker process that uses the same SQLite file.
+    A request reserves its expanded bar count; while the budget is used up, requests wait in a bounded queue
+    and start in arrival order. Full queue or too many requests from one client -> 429,
+    waiting longer than queue_timeout_s -> 503.
+    Holders refresh their reservations every HEARTBEAT_S; reservations not refreshed for STALE_S
+    (their process died, also one in another container) are dropped.
+    """
+    POLL_INTERVAL_S = 0.05
+    HEARTBEAT_S = 5.0
+    STALE_S = 60.0
+
+    def __init__(self, limits: Limits, path: str):
+        self.limits = limits
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            columns = {row[1] for row in db.execute("PRAGMA table_info(reservations)")}
+            if columns and "heartbeat_at" not in columns:
+                db.execute("DROP TABLE reservations")  # left by an older version, reservations are transient
+            db.execute("""CREATE TABLE IF NOT EXISTS reservations (
+                id INTEGER PRIMARY KEY,
+                client TEXT NOT NULL,
+                cost INTEGER NOT NULL,
+                running INTEGER NOT NULL,
+                heartbeat_at REAL NOT NULL
+            )""")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @property
+    def in_use(self) -> int:
+        with self._connect() as db:
+            return db.execute("SELECT COALESCE(SUM(cost), 0) FROM reservations WHERE running").fetchone()[0]
+
+    @property
+    def queued(self) -> int:
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM reservations WHERE NOT running").fetchone()[0]
+
+    @property
+    def per_client(self) -> dict[str, int]:
+        with self._connect() as db:
+            return dict(db.execute("SELECT client, COUNT(*) FROM reservations GROUP BY client").fetchall())
+
+    @asynccontextmanager
+    async def reserve(self, cost: int, client: str = ""):
+        # a chart bigger than the whole budget may still run, alone
+        cost = min(max(cost, 1), self.limits.budget_bars)
+        reservation = await self._acquire(cost, client)
+        heartbeat = asyncio.create_task(self._keep_alive(reservation))
+        try:
+            yield
+        finally:
+            heartbeat.cancel()
+            await asyncio.to_thread(self._release, reservation)
+
+    async def _acquire(self, cost: int, client: str) -> int:
+        reservation, running = await asyncio.to_thread(self._enter, cost, client)
+        try:
+            deadline = time.monotonic() + self.limits.queue_timeout_s
+            while not running:
+                if time.monotonic() >= deadline:
+                    raise AdmissionError(503, "Server is busy, the request waited too long for a render slot.",
+                                         retry_after=math.ceil(self.limits.queue_timeout_s))
+                await asyncio.sleep(self.POLL_INTERVAL_S)
+                running = await asyncio.to_thread(self._try_start, reservation, cost)
+        except BaseException:
+            await asyncio.to_thread(self._release, reservation)
+            raise
+        return reservation
+
+    async def _keep_alive(self, reservation: int):
+        while True:
+            await asyncio.sleep(self.HEARTBEAT_S)
+            await asyncio.to_thread(self._beat, reservation)
+
+    def _transaction(self, work):
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")  # one process at a time decides who gets budget
+            result = work(db)
+            db.execute("COMMIT")
+            return result
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+
+    def _enter(self, cost: int, client: str) -> tuple[int, bool]:
+        """Adds a reservation, running if it fits right away and nobody is queued before it; returns (id, running)."""
+        def enter(db) -> tuple[int, bool]:
+            self._drop_stale(db)
+            if self.limits.max_per_client and db.execute(
+                    "SELECT COUNT(*) FROM reservations WHERE client = ?", (client,)).fetchone()[0] >= self.limits.max_per_client:
+                raise AdmissionError(429, "Too many requests from this client are already in progress.",
+                                     retry_after=math.ceil(self.limits.queue_timeout_s))
+            waiting = db.execute("SELECT COUNT(*) FROM reservations WHERE NOT running").fetchone()[0]
+            starts = not waiting and self._fits(db, cost)
+            if not starts and waiting >= self.limits.max_queued:
+                raise AdmissionError(429, "Render queue is full, try again later.",
+                                     retry_after=math.ceil(self.limits.queue_timeout_s))
+            cursor = db.execute("INSERT INTO reservations (client, cost, running, heartbeat_at) VALUES (?, ?, ?, ?)",
+                                (client, cost, int(starts), time.time()))
+            return cursor.lastrowid, starts
+        return self._transaction(enter)
+
+    def _try_start(self, reservation: int, cost: int) -> bool:
+        def start(db) -> bool:
+            db.execute("UPDATE reservations SET heartbeat_at = ? WHERE id = ?", (time.time(), reservation))
+            self._drop_stale(db)
+            # first come, first served: a big chart is not starved by smaller ones that keep fitting in
+            if db.execute("SELECT COUNT(*) FROM reservations WHERE NOT running AND id < ?",
+                          (reservation,)).fetchone()[0] or not self._fits(db, cost):
+                return False
+            db.execute("UPDATE reservations SET running = 1 WHERE id = ?", (reservation,))
+            return True
+        return self._transaction(start)
+
+    def _fits(self, db, cost: int) -> bool:
+        in_use = db.execute("SELECT COALESCE(SUM(cost), 0) FROM reservations WHERE running").fetchone()[0]
+        return in_use + cost <= self.limits.budget_bars
+
+    def _drop_stale(self, db):
+        db.execute("DELETE FROM reservations WHERE heartbeat_at < ?", (time.time() - self.STALE_S,))
+
+    def _beat(self, reservation: int):
+        with self._connect() as db:
+            db.execute("UPDATE reservations SET heartbeat_at = ? WHERE id = ?", (time.time(), reservation))
+
+    def _release(self, reservation: int):
+        with self._connect() as db:
+            db.execute("DELETE FROM reservations WHERE id = ?", (reservation,))
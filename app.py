@@ -6,21 +6,79 @@ import shutil # For cleaning up temp files
 import uuid   # For unique filenames
 import subprocess
 import traceback # For detailed error logging
+import asyncio
+import time
+from starlette.concurrency import run_in_threadpool
 
 # Imports from other project files
-from bass import ChordProgression
-from drums import DrumPattern
-from music21 import stream, note as m21_note, instrument, environment
+import pipeline
+from pipeline import TEMP_BASE_DIR, STEMS_DIR, TEMPO, QUARTERS_PER_BAR, BASS_CANDIDATES, render_composition
+from sound_combiner import StemMix
+from profiling import RequestProfiler, prune_reports
+from admission import AdmissionError, Limits, RenderBudget, check_chart
+from singleflight import SingleFlight, request_key
+from broker import DONE, FileArtifactStore, SQLiteBroker
+from worker import ARTIFACTS_DIR, BROKER_DB, JOB_LEASE_S
 
 app = FastAPI()
 
-# Setup Constants and Directories
-msc_path = environment.get("musicxmlPath")
-if not msc_path:
-    print("Warning: MuseScore path not found in music21 environment. WAV generation will fail.")
+# Chart size limits and the render budget shared by all uvicorn workers, configurable through JAZZCOMP_* variables (see admission.py)
+LIMITS = Limits.from_env()
+RENDER_BUDGET = RenderBudget(LIMITS, os.path.join(TEMP_BASE_DIR, "budget.sqlite"))
+# Behind a reverse proxy every request comes from the proxy's address. Set JAZZCOMP_CLIENT_IP_HEADER
+# (e.g. X-Forwarded-For) to the header the trusted proxy fills in, so per-client limits see real clients.
+CLIENT_IP_HEADER = os.environ.get("JAZZCOMP_CLIENT_IP_HEADER", "")
 
-TEMP_BASE_DIR = "temp_audio_FastAPI"
-os.makedirs(TEMP_BASE_DIR, exist_ok=True)
+# Identical requests in flight at the same time (same normalized chart and parameters) share one render,
+# also across uvicorn workers. A request arriving after a render finished gets its own; the finished result
+# is kept JAZZCOMP_SINGLEFLIGHT_TTL_S seconds, just long enough for the waiting requests to pick it up
+SINGLE_FLIGHT = SingleFlight(os.path.join(TEMP_BASE_DIR, "singleflight"),
+                             ttl_s=float(os.environ.get("JAZZCOMP_SINGLEFLIGHT_TTL_S", "5")),
+                             wait_timeout_s=LIMITS.queue_timeout_s + 600)
+
+# JAZZCOMP_RENDER_MODE=local renders in this process; =broker queues jobs for render workers (worker.py)
+# and serves the WAV they put into the artifact store, so rendering scales separately from HTTP serving
+RENDER_MODE = os.environ.get("JAZZCOMP_RENDER_MODE", "local")
+JOB_TIMEOUT_S = float(os.environ.get("JAZZCOMP_JOB_TIMEOUT_S", "600"))
+JOB_POLL_INTERVAL_S = 0.2
+BROKER = SQLiteBroker(BROKER_DB, lease_s=JOB_LEASE_S) if RENDER_MODE == "broker" else None
+ARTIFACTS = FileArtifactStore(ARTIFACTS_DIR) if RENDER_MODE == "broker" else None
+
+# Opt-in per-request profiling: the request sets the `profile` form field or an `X-Profile: 1` header,
+# and the server must allow it. Reports are kept in PROFILES_DIR and served by /profiles/.
+PROFILING_ENABLED = os.environ.get("JAZZCOMP_PROFILING", "") == "1"
+PROFILES_DIR = os.path.join(TEMP_BASE_DIR, "profiles")
+PROFILES_MAX_COUNT = int(os.environ.get("JAZZCOMP_PROFILES_MAX_COUNT", "100"))
+PROFILES_MAX_AGE_S = float(os.environ.get("JAZZCOMP_PROFILES_MAX_AGE_S", "86400"))
+
+def _link_or_copy(source: str, destination: str):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def _load_stems(stem_dir: str | None) -> StemMix | None:
+    if stem_dir is None:
+        return None
+    try:
+        return StemMix.load(stem_dir)
+    except FileNotFoundError:
+        return None  # pruned after the directory was found
+
+def _client_key(request: Request) -> str:
+    forwarded = request.headers.get(CLIENT_IP_HEADER, "") if CLIENT_IP_HEADER else ""
+    if forwarded:
+        # the proxy appends the address it saw; anything before it came from the client and can be forged
+        return forwarded.split(",")[-1].strip()
+    return request.client.host if request.client else ""
+
+def _stem_session_dir(session_id: str) -> str | None:
+    try:
+        uuid.UUID(session_id)  # also keeps the path inside STEMS_DIR
+    except ValueError:
+        return None
+    stem_dir = os.path.join(STEMS_DIR, session_id)
+    return stem_dir if os.path.isdir(stem_dir) else None
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root():
@@ -28,75 +86,104 @@ async def read_root():
     with open("form.html", "r") as file:
         return file.read()
 
+def render_composition_profiled(profiler: RequestProfiler, chord_progression: str, session_id: str, session_temp_dir: str,
+                                base_session_id: str | None = None) -> str:
+    try:
+        with profiler:
+            return render_composition(chord_progression, session_id, session_temp_dir, base_session_id)
+    finally:
+        # failed renders are profiled too, they are often the slow ones
+        profiler.save(PROFILES_DIR, session_id)
+        prune_reports(PROFILES_DIR, PROFILES_MAX_COUNT, PROFILES_MAX_AGE_S)
+        print(f"Session {session_id}: Profile saved, see /profiles/{session_id}")
+
+async def render_on_worker(chord_progression: str, session_id: str, result_dir: str, base_session_id: str | None = None) -> str:
+    """Queues the render for a worker, waits for it and copies the artifact into result_dir."""
+    job_id = await run_in_threadpool(BROKER.submit, {"chord_progression": chord_progression, "session_id": session_id,
+                                                     "base_session_id": base_session_id})
+    print(f"Session {session_id}: Queued as job {job_id}.")
+    deadline = time.monotonic() + JOB_TIMEOUT_S
+    try:
+        while True:
+            job = await run_in_threadpool(BROKER.get, job_id)
+            if job.finished:
+                break
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Job {job_id} did not finish within {JOB_TIMEOUT_S:.0f} s.")
+            await asyncio.sleep(JOB_POLL_INTERVAL_S)
+        if job.status != DONE:
+            raise RuntimeError(f"Render job {job_id} {job.status}: {job.error}")
+        wav_path = os.path.join(result_dir, job.result["wav"])
+        await run_in_threadpool(shutil.copyfile, ARTIFACTS.path(job_id, job.result["wav"]), wav_path)
+        return wav_path
+    except BaseException:
+        # timed out or the request went away: no worker should start the job, and one already rendering it
+        # discards the result (a finished job is left as it is)
+        BROKER.cancel(job_id)
+        raise
+    finally:
+        ARTIFACTS.delete(job_id)
+
 @app.post("/generate_jazz_composition/")
-async def generate_composition_endpoint(request: Request, chord_progression: str = Form(...)):
+async def generate_composition_endpoint(request: Request, chord_progression: str = Form(...), profile: bool = Form(False),
+                                        base_session_id: str = Form("")):
+    """
+    Renders a chart. With base_session_id (the X-Session-Id of an earlier response) the chart is treated as an edit
+    of that session and only the changed bars are rendered again; the response gets a new session id either way.
+    """
     session_id = str(uuid.uuid4())
     session_temp_dir = os.path.join(TEMP_BASE_DIR, session_id)
     os.makedirs(session_temp_dir, exist_ok=True)
 
-    bass_xml_path = os.path.join(session_temp_dir, "bass_line.xml")
-    bass_wav_path = os.path.join(session_temp_dir, "bass_line.wav")
-    final_wav_path = os.path.join(session_temp_dir, "final_composition.wav")
+    headers = {"X-Session-Id": session_id}
+    profile_requested = profile or request.headers.get("X-Profile", "").lower() in ("1", "true", "yes")
+    if profile_requested and not PROFILING_ENABLED:
+        print(f"Session {session_id}: Profiling requested but disabled (set JAZZCOMP_PROFILING=1 to allow it).")
+    profiler = RequestProfiler() if profile_requested and PROFILING_ENABLED else None
 
     try:
-        if not msc_path:
+        if (BROKER is None or profiler is not None) and not pipeline.msc_path:
             print("Error: MuseScore path not configured at the time of request.")
-            return HTMLResponse("Error: MuseScore path not configured. Cannot generate WAV files.", status_code=500)
-
-        # 1. Parse Chord Progression
-        print(f"Session {session_id}: Parsing chord progression:\n{chord_progression}")
-        prog = ChordProgression.from_string(chord_progression)
-
-        # 2. Generate Bass Line
-        print(f"Session {session_id}: Generating bass line...")
-        bassline_notes = prog.generate_bass_line()
-        bass_stream = stream.Stream()
-        bass_stream.insert(0, instrument.AcousticBass())
-        for note_obj in bassline_notes:
-            m21_note_obj = m21_note.Note(note_obj.to_midi())
-            m21_note_obj.duration.quarterLength = note_obj.length/2
-            bass_stream.append(m21_note_obj)
-
-        if len(bass_stream) > 0:
-            print(f"Session {session_id}: Writing bass XML to {bass_xml_path}")
-            bass_stream.write('musicxml', fp=bass_xml_path)
-            print(f"Session {session_id}: Converting bass XML to WAV at {bass_wav_path} using {msc_path}")
-            subprocess.run([msc_path, bass_xml_path, '-o', bass_wav_path], check=True, capture_output=True)
-            print(f"Session {session_id}: Bass WAV generated.")
-        else:
-            print(f"Session {session_id}: Bass stream empty or invalid, skipping WAV generation for bass.")
-
+            return HTMLResponse("Error: MuseScore path not configured. Cannot generate WAV files.", status_code=500, headers=headers)
 
+        # Cheap pre-pass on the raw text: oversized charts never reach the parser
+        cost = check_chart(chord_progression, LIMITS, TEMPO, QUARTERS_PER_BAR)
+        print(f"Session {session_id}: Estimated {cost.bars} bars, {cost.duration_s:.0f} s of audio.")
+        if profiler is not None:
+            headers["X-Profile-Id"] = session_id
 
-        # 4. Generate Drums and Combine
-        print(f"Session {session_id}: Generating drums and combining audio...")
-        expanded_prog_items = list(prog)
-        total_quarters = sum(item.duration for item in expanded_prog_items if item.is_chord and hasattr(item, 'duration'))
-
-        num_bars = (int(total_quarters) + 3) // 4 # Assuming 4/4 time
-        if num_bars == 0 and total_quarters > 0 : num_bars = 1
-        if num_bars == 0:
-            print(f"Session {session_id}: No calculable bars from progression, defaulting to 4 bars for drums.")
-            num_bars = 4
-
-        print(f"Session {session_id}: Calculated {total_quarters} total quarters, resulting in {num_bars} bars for drums.")
-
-        tempo = 120
-        num_quarters_per_bar = 4
-
-        drum_machine = DrumPattern(tempo=tempo, num_quarters=num_quarters_per_bar)
-        drum_machine.create_pattern(bars=num_bars)
-        print(f"Session {session_id}: Drum pattern created with {len(drum_machine.combiner.main_audio)} sound ms.")
-
-        if os.path.exists(bass_wav_path):
-            print(f"Session {session_id}: Adding bass WAV to drum combiner.")
-            drum_machine.combiner.place_at(bass_wav_path, 0, 0, volume_step=10.0)
+        # Rendering runs in a worker thread, so the event loop keeps serving while the budget queues requests
+        client = _client_key(request)
+        if profiler is not None:
+            # a profiled request wants its own render measured, it is never coalesced nor sent to a worker
+            async with RENDER_BUDGET.reserve(cost.bars, client):
+                final_wav_path = await run_in_threadpool(render_composition_profiled, profiler, chord_progression,
+                                                         session_id, session_temp_dir, base_session_id or None)
         else:
-            print(f"Session {session_id}: Bass WAV not found at {bass_wav_path}, not adding to mix.")
+            async def render_shared(result_dir: str) -> dict:
+                # only the request that renders takes budget; identical ones wait for its result.
+                # In broker mode the budget bounds the jobs this process keeps queued.
+                async with RENDER_BUDGET.reserve(cost.bars, client):
+                    if BROKER is not None:
+                        wav_path = await render_on_worker(chord_progression, session_id, result_dir, base_session_id or None)
+                    else:
+                        wav_path = await run_in_threadpool(render_composition, chord_progression, session_id, result_dir,
+                                                           base_session_id or None)
+                return {"session_id": session_id, "wav": os.path.basename(wav_path)}
 
-        print(f"Session {session_id}: Exporting final combined audio to {final_wav_path}")
-        drum_machine.combiner.export(final_wav_path)
-        print(f"Session {session_id}: Final WAV exported.")
+            key = request_key(chord_progression, tempo=TEMPO, quarters_per_bar=QUARTERS_PER_BAR,
+                              bass_candidates=BASS_CANDIDATES, base_session_id=base_session_id)
+            try:
+                result = await SINGLE_FLIGHT.run(key, render_shared)
+            except TimeoutError as e:
+                raise AdmissionError(503, f"Timed out waiting for the render: {e}",
+                                     retry_after=int(LIMITS.queue_timeout_s)) from None
+            if result.shared:
+                print(f"Session {session_id}: Served the result of identical session {result.meta['session_id']}.")
+                headers["X-Session-Id"] = result.meta["session_id"]  # its stems are the ones /remix/ can use
+            # each response gets its own link to the shared file, so its cleanup cannot affect the others
+            final_wav_path = os.path.join(session_temp_dir, "final_composition.wav")
+            _link_or_copy(os.path.join(result.result_dir, result.meta["wav"]), final_wav_path)
 
         # 5. Return FileResponse and schedule cleanup
         background_tasks_for_cleanup = BackgroundTasks()
@@ -106,19 +193,26 @@ async def generate_composition_endpoint(request: Request, chord_progression: str
         return FileResponse(final_wav_path,
                             media_type='audio/wav',
                             filename='jazz_composition.wav',
+                            headers=headers,
                             background=background_tasks_for_cleanup)
 
+    except AdmissionError as e:
+        print(f"Session {session_id}: Rejected with {e.status_code}: {e}")
+        if os.path.exists(session_temp_dir): shutil.rmtree(session_temp_dir)
+        if e.retry_after is not None:
+            headers["Retry-After"] = str(e.retry_after)
+        return HTMLResponse(f"Error: {e}", status_code=e.status_code, headers=headers)
     except FileNotFoundError as e:
-        if msc_path and str(e.filename) == msc_path:
-            print(f"Session {session_id}: MuseScore executable not found at: {msc_path}. Error: {e}")
+        if pipeline.msc_path and str(e.filename) == pipeline.msc_path:
+            print(f"Session {session_id}: MuseScore executable not found at: {pipeline.msc_path}. Error: {e}")
             # Clean up before returning, as FileResponse background task won't run. This is important.
             if os.path.exists(session_temp_dir): shutil.rmtree(session_temp_dir)
-            return HTMLResponse(f"Error: MuseScore executable not found at '{msc_path}'. Please configure it correctly.", status_code=500)
+            return HTMLResponse(f"Error: MuseScore executable not found at '{pipeline.msc_path}'. Please configure it correctly.", status_code=500, headers=headers)
         print(f"Session {session_id}: FileNotFoundError in generation: {e}")
         traceback.print_exc()
         # Clean up before returning.
         if os.path.exists(session_temp_dir): shutil.rmtree(session_temp_dir)
-        return HTMLResponse(f"Error during generation: File not found - {e.filename}", status_code=500)
+        return HTMLResponse(f"Error during generation: File not found - {e.filename}", status_code=500, headers=headers)
     except subprocess.CalledProcessError as e:
         print(f"Session {session_id}: Error during MuseScore conversion. Return code: {e.returncode}")
         print(f"Stdout: {e.stdout.decode() if e.stdout else 'N/A'}")
@@ -126,13 +220,73 @@ async def generate_composition_endpoint(request: Request, chord_progression: str
         traceback.print_exc()
         # Clean up before returning.
         if os.path.exists(session_temp_dir): shutil.rmtree(session_temp_dir)
-        return HTMLResponse(f"Error during audio conversion (MuseScore): {e.cmd} failed. Stderr: {e.stderr.decode() if e.stderr else 'N/A'}", status_code=500)
+        return HTMLResponse(f"Error during audio conversion (MuseScore): {e.cmd} failed. Stderr: {e.stderr.decode() if e.stderr else 'N/A'}", status_code=500, headers=headers)
     except Exception as e:
         print(f"Session {session_id}: An unexpected error occurred: {e}")
         traceback.print_exc()
         # Clean up before returning.
         if os.path.exists(session_temp_dir): shutil.rmtree(session_temp_dir)
-        return HTMLResponse(f"An unexpected error occurred during generation: {str(e)}", status_code=500)
+        return HTMLResponse(f"An unexpected error occurred during generation: {str(e)}", status_code=500, headers=headers)
+
+@app.get("/profiles/{profile_id}")
+async def profile_endpoint(profile_id: str, format: str = "text"):
+    """Top-N table (format=text) or flame-graph stacks (format=collapsed) of a profiled generation."""
+    if not PROFILING_ENABLED:
+        return HTMLResponse("Error: Profiling is disabled.", status_code=404)
+    try:
+        uuid.UUID(profile_id)
+    except ValueError:
+        return HTMLResponse(f"Error: Invalid profile id '{profile_id}'.", status_code=404)
+    extension = {"text": "txt", "collapsed": "collapsed"}.get(format)
+    if extension is None:
+        return HTMLResponse("Error: format must be 'text' or 'collapsed'.", status_code=400)
+    report_path = os.path.join(PROFILES_DIR, f"{profile_id}.{extension}")
+    if not os.path.exists(report_path):
+        return HTMLResponse(f"Error: No profile '{profile_id}'.", status_code=404)
+    return FileResponse(report_path, media_type="text/plain")
+
+@app.post("/remix/{session_id}")
+async def remix_endpoint(session_id: str, request: Request):
+    """
+    Re-balances the cached stems of a previous generation.
+    Form fields: <stem>_gain (dB relative to the rendered level) and <stem>_mute (any non-empty value),
+    where <stem> is one of the names reported by GET /remix/{session_id}.
+    """
+    stem_dir = _stem_session_dir(session_id)
+    stem_mix = _load_stems(stem_dir)
+    if stem_mix is None:
+        return HTMLResponse(f"Error: No cached stems for session '{session_id}'.", status_code=404)
+    form = await request.form()
+    mutes = {name for name in stem_mix.names if form.get(f"{name}_mute")}
+    try:
+        gains = {name: float(form[f"{name}_gain"]) for name in stem_mix.names if form.get(f"{name}_gain")}
+        stem_mix.weights(gains, mutes)
+    except ValueError as e:
+        return HTMLResponse(f"Error: Invalid gain value: {e}", status_code=400)
+
+    remix_wav_path = os.path.join(TEMP_BASE_DIR, f"remix_{uuid.uuid4()}.wav")
+    print(f"Session {session_id}: Remixing with gains {gains} and mutes {sorted(mutes)}")
+    # the weighted sum over every stem and the export take as long as the song, keep them off the event loop
+    await run_in_threadpool(lambda: stem_mix.remix(gains, mutes).export(remix_wav_path, format="wav"))
+    try:
+        os.utime(stem_dir)  # recently remixed sessions survive pruning
+    except FileNotFoundError:
+        pass  # pruned while remixing; the remix itself read from the memory map
+
+    cleanup = BackgroundTasks()
+    cleanup.add_task(os.remove, remix_wav_path)
+    return FileResponse(remix_wav_path,
+                        media_type='audio/wav',
+                        filename='jazz_composition_remix.wav',
+                        headers={"X-Session-Id": session_id},
+                        background=cleanup)
+
+@app.get("/remix/{session_id}")
+async def remix_stems_endpoint(session_id: str):
+    stem_mix = _load_stems(_stem_session_dir(session_id))
+    if stem_mix is None:
+        return HTMLResponse(f"Error: No cached stems for session '{session_id}'.", status_code=404)
+    return {"session_id": session_id, "stems": stem_mix.names, "duration_ms": stem_mix.duration_ms}
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,5 +1,6 @@
 from harmony import Chord, Parser, generate_bass_bar
 from notes_with_octaves import NoteWithOctave
+import bass_batch
 
 class ProgressionItem:
     def __init__(self, chord: Chord | None = None, duration: int = 0, event_data: str | None = None):
@@ -182,3 +183,10 @@ class ChordProgression:
                 final_bass_line.extend(bass_segment)
         return final_bass_line
 
+    def generate_best_bass_line(self, candidates: int = bass_batch.DEFAULT_CANDIDATES) -> list[NoteWithOctave]:
+        """
+        Generates `candidates` walks over the whole progression at once and returns the best scoring one
+        (see bass_batch). Same shape as generate_bass_line: one note per quarter, ending on the first chord's root.
+        """
+        spans = bass_batch.spans_from_items(list(self))
+        return bass_batch.to_notes(bass_batch.best_walk(spans, candidates))
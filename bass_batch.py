@@ -0,0 +1,165 @@
+"""
+Batched bass line generation.
+Generates many candidate walking lines for a whole progression at once as NumPy arrays of MIDI numbers,
+scores them all with vectorized rules and keeps the best one. Chord theory (scales, gravitating notes)
+comes from harmony.py and is computed once per distinct chord; the walk itself is NumPy only.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+from chordparser import Chord, Note, Parser
+
+from harmony import LOWER_BOUND, UPPER_BOUND, chord_to_scale, get_gravitating_notes
+from notes_with_octaves import NoteWithOctave
+
+DEFAULT_CANDIDATES = 64
+STEPS = np.array([-2, -1, 1, 2])  # moves along the scale between walk notes, like generate_bass_bar
+MAX_APPROACH_LEAP = 7  # approach notes are picked among gravitating notes at most this far from the last walk note
+
+# weights of the scoring rules, per note (see score_walks)
+APPROACH_WEIGHT = 3.0
+LEAP_WEIGHT = 1.0
+REPEAT_WEIGHT = 2.0
+RANGE_WEIGHT = 0.5
+EXTREME_WEIGHT = 1.0
+
+@dataclass
+class ChordSpan:
+    """One chord of the walk: the chord, the chord it leads to and how many quarters it lasts."""
+    chord: Chord
+    next_chord: Chord
+    quarters: int
+
+    @property
+    def note_count(self) -> int:
+        # root, quarters-2 walk notes, approach note; a one-quarter chord only gets its root
+        return max(self.quarters, 1)
+
+@dataclass
+class _ChordPitches:
+    scale: np.ndarray  # in-bounds MIDI numbers of the chord scale, ascending
+    roots: np.ndarray  # in-bounds MIDI numbers of the root
+    approaches: np.ndarray  # in-bounds MIDI numbers of the notes that gravitate to the root
+    root: Note
+
+_pitch_cache: dict[str, _ChordPitches] = {}
+
+def _in_bounds(notes: list[Note]) -> np.ndarray:
+    pitch_classes = {note.num_value() % 12 for note in notes}
+    return np.array([midi for midi in range(LOWER_BOUND, UPPER_BOUND + 1) if midi % 12 in pitch_classes], dtype=np.int64)
+
+def chord_pitches(chord: Chord) -> _ChordPitches:
+    key = str(chord)
+    if key not in _pitch_cache:
+        gravitating = get_gravitating_notes(chord)
+        roots = _in_bounds([chord.root])
+        if gravitating:
+            approaches = _in_bounds(gravitating)
+        else:
+            # triads and sus chords have no gravitating notes, fall back to chromatic neighbours of the root
+            approaches = np.union1d(roots - 1, roots + 1)
+            approaches = approaches[(approaches >= LOWER_BOUND) & (approaches <= UPPER_BOUND)]
+        _pitch_cache[key] = _ChordPitches(_in_bounds(chord_to_scale(Parser(), chord)), roots, approaches, chord.root)
+    return _pitch_cache[key]
+
+def spans_from_items(items) -> list[ChordSpan]:
+    """ChordSpans of an expanded progression (list(ChordProgression)); the last chord leads back to the first."""
+    playable = [item for item in items if item.is_chord and item.duration > 0]
+    return [ChordSpan(item.chord, playable[(i + 1) % len(playable)].chord, item.duration)
+            for i, item in enumerate(playable)]
+
+def _closest(pitches: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """For every target, the closest of `pitches`."""
+    return pitches[np.abs(pitches[None, :] - targets[:, None]).argmin(axis=1)]
+
+def _walk_step(scale: np.ndarray, current: np.ndarray, rng: np.random.Generator) -> np.ndarray:
+    index = np.clip(np.searchsorted(scale, current), 0, len(scale) - 1)
+    step = rng.choice(STEPS, size=len(current))
+    moved = np.clip(index + step, 0, len(scale) - 1)
+    # stepping out of range lands on the same note; bounce back the other way instead
+    stuck = scale[moved] == current
+    moved[stuck] = np.clip(index[stuck] - step[stuck], 0, len(scale) - 1)
+    return scale[moved]
+
+def _pick_approach(approaches: np.ndarray, current: np.ndarray, target: int | None, rng: np.random.Generator) -> np.ndarray:
+    distance = np.abs(approaches[None, :] - current[:, None])
+    allowed = (distance > 0) & (distance <= MAX_APPROACH_LEAP)
+    if target is not None:
+        allowed &= np.abs(approaches - target)[None, :] <= MAX_APPROACH_LEAP
+    # random choice among the allowed notes, closest non-repeated note when none is allowed
+    choice = np.where(allowed, rng.random(allowed.shape), -1.0).argmax(axis=1)
+    fallback = np.where(distance > 0, distance, np.iinfo(np.int64).max).argmin(axis=1)
+    return approaches[np.where(allowed.any(axis=1), choice, fallback)]
+
+def generate_walks(spans: list[ChordSpan], candidates: int = DEFAULT_CANDIDATES, start: int | None = None,
+                   end: int | None = None, rng: np.random.Generator | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Generates `candidates` walks over the spans at once.
+    Returns (walks, approach_columns): walks has shape (candidates, sum of note counts + 1), the last column being
+    the root the line resolves to; approach_columns are the indices of the approach notes.
+    start fixes the first note (default: the first root in octave 2); end fixes the final note, for splicing
+    a regenerated stretch into an existing line.
+    """
+    rng = rng or np.random.default_rng()
+    total = sum(span.note_count for span in spans)
+    walks = np.empty((candidates, total + 1), dtype=np.int64)
+    approach_columns = []
+    if not spans:
+        return walks[:, :0], np.array(approach_columns, dtype=np.int64)
+
+    first = chord_pitches(spans[0].chord)
+    walks[:, 0] = start if start is not None else _closest(first.roots, np.array([36]))[0]  # 36 = C2
+    column = 0
+    for i, span in enumerate(spans):
+        pitches = chord_pitches(span.chord)
+        next_pitches = chord_pitches(span.next_chord)
+        last_span = i == len(spans) - 1
+        for _ in range(span.note_count - 2):
+            walks[:, column + 1] = _walk_step(pitches.scale, walks[:, column], rng)
+            column += 1
+        if span.note_count >= 2:
+            target = end if last_span else None
+            walks[:, column + 1] = _pick_approach(next_pitches.approaches, walks[:, column], target, rng)
+            column += 1
+            approach_columns.append(column)
+        # the next chord starts on its root, as close as possible to where the line is
+        walks[:, column + 1] = end if (last_span and end is not None) else _closest(next_pitches.roots, walks[:, column])
+        column += 1
+    return walks, np.array(approach_columns, dtype=np.int64)
+
+def score_walks(walks: np.ndarray, approach_columns: np.ndarray) -> np.ndarray:
+    """
+    Scores every candidate walk (higher is better), all rules vectorized over candidates:
+    chromatic or fifth approaches into the next root, few leaps, few repeated notes,
+    using a good part of the range without sitting at its edges.
+    """
+    notes = walks.shape[1]
+    if notes < 2:
+        return np.zeros(len(walks))
+    intervals = np.abs(np.diff(walks, axis=1))
+    leaps = np.clip(intervals - 2, 0, None).sum(axis=1) + 2 * (intervals > 7).sum(axis=1)
+    repeats = (intervals == 0).sum(axis=1)
+    span = walks.max(axis=1) - walks.min(axis=1)
+    extremes = ((walks <= LOWER_BOUND + 1) | (walks >= UPPER_BOUND - 1)).sum(axis=1)
+
+    approach_quality = np.zeros(len(walks))
+    if len(approach_columns):
+        into_root = np.abs(walks[:, approach_columns + 1] - walks[:, approach_columns])
+        quality = np.select([into_root == 1, (into_root == 5) | (into_root == 7), into_root == 2],
+                            [1.0, 0.6, 0.3], default=0.0)
+        approach_quality = quality.mean(axis=1)
+
+    return (APPROACH_WEIGHT * approach_quality
+            - LEAP_WEIGHT * leaps / notes
+            - REPEAT_WEIGHT * repeats / notes
+            + RANGE_WEIGHT * np.minimum(span, 12) / 12
+            - EXTREME_WEIGHT * extremes / notes)
+
+def best_walk(spans: list[ChordSpan], candidates: int = DEFAULT_CANDIDATES, start: int | None = None,
+              end: int | None = None, rng: np.random.Generator | None = None) -> np.ndarray:
+    """MIDI numbers of the best scoring of `candidates` walks (see generate_walks for start and end)."""
+    walks, approach_columns = generate_walks(spans, max(candidates, 1), start, end, rng)
+    return walks[score_walks(walks, approach_columns).argmax()] if walks.shape[1] else walks[0]
+
+def to_notes(midi_numbers) -> list[NoteWithOctave]:
+    return [NoteWithOctave.from_midi(int(midi)) for midi in midi_numbers]
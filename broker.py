@@ -0,0 +1,216 @@
+"""
+Job broker and artifact store for running the render pipeline outside the web process.
+The app submits jobs and waits for their results; render workers (worker.py) claim jobs, render them
+and put the output into the artifact store. Broker and ArtifactStore are the interfaces other backends
+implement; SQLiteBroker and FileArtifactStore are the reference implementations for a single host and tests.
+"""
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+@dataclass
+class Job:
+    id: str
+    payload: dict
+    status: str = QUEUED
+    result: dict | None = None
+    error: str | None = None
+    attempts: int = 0
+    worker_id: str | None = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED, CANCELLED)
+
+class Broker(ABC):
+    lease_s: float = 600.0  # a claim expires after this long unless its worker renews it
+
+    @abstractmethod
+    def submit(self, payload: dict) -> str:
+        """Queues a job and returns its id."""
+
+    @abstractmethod
+    def claim(self, worker_id: str) -> Job | None:
+        """Hands the oldest claimable job to worker_id, or returns None when there is nothing to do."""
+
+    @abstractmethod
+    def renew(self, job_id: str, worker_id: str) -> bool:
+        """Extends the lease of worker_id on a running job; False if the claim is no longer its own."""
+
+    @abstractmethod
+    def complete(self, job_id: str, result: dict, worker_id: str) -> bool:
+        """
+        Records the result of the claim of worker_id; False if that claim is gone:
+        the job was cancelled, or its lease expired and another worker claimed it.
+        """
+
+    @abstractmethod
+    def fail(self, job_id: str, error: str, worker_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    def cancel(self, job_id: str):
+        """Gives up on an unfinished job: workers skip it if queued and discard its result if running."""
+
+    @abstractmethod
+    def get(self, job_id: str) -> Job | None:
+        ...
+
+    @abstractmethod
+    def purge(self, older_than_s: float) -> list[str]:
+        """Deletes finished jobs older than older_than_s seconds and returns their ids."""
+
+class ArtifactStore(ABC):
+    @abstractmethod
+    def put(self, job_id: str, name: str, source_path: str):
+        """Stores the file at source_path as artifact `name` of the job."""
+
+    @abstractmethod
+    def path(self, job_id: str, name: str) -> str:
+        """Local path of a stored artifact, for serving or copying it."""
+
+    @abstractmethod
+    def delete(self, job_id: str):
+        ...
+
+class SQLiteBroker(Broker):
+    """
+    Job queue in one SQLite file, safe for several processes on one host.
+    A claimed job is leased for lease_s seconds; if its worker dies without completing it,
+    the job becomes claimable again, up to max_attempts claims.
+    """
+    def __init__(self, path: str, lease_s: float = 600.0, max_attempts: int = 3):
+        self.path = path
+        self.lease_s = lease_s
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                worker_id TEXT,
+                created_at REAL NOT NULL,
+                lease_expires_at REAL
+            )""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status_created ON jobs (status, created_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # a connection per call keeps the broker usable from any thread or process
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def submit(self, payload: dict) -> str:
+        job_id = str(uuid.uuid4())
+        with self._connect() as db:
+            db.execute("INSERT INTO jobs (id, payload, status, created_at) VALUES (?, ?, ?, ?)",
+                       (job_id, json.dumps(payload), QUEUED, time.time()))
+        return job_id
+
+    def claim(self, worker_id: str) -> Job | None:
+        now = time.time()
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")  # one claimer at a time, so a job is never handed out twice
+            # jobs whose worker died and that used up their attempts are given up on
+            db.execute("UPDATE jobs SET status = ?, error = ? WHERE status = ? AND lease_expires_at < ? AND attempts >= ?",
+                       (FAILED, "Worker lease expired too many times.", RUNNING, now, self.max_attempts))
+            row = db.execute("""SELECT * FROM jobs
+                                WHERE status = ? OR (status = ? AND lease_expires_at < ?)
+                                ORDER BY created_at LIMIT 1""", (QUEUED, RUNNING, now)).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            db.execute("UPDATE jobs SET status = ?, worker_id = ?, attempts = attempts + 1, lease_expires_at = ? WHERE id = ?",
+                       (RUNNING, worker_id, now + self.lease_s, row["id"]))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+        return Job(row["id"], json.loads(row["payload"]), RUNNING, attempts=row["attempts"] + 1, worker_id=worker_id)
+
+    def renew(self, job_id: str, worker_id: str) -> bool:
+        with self._connect() as db:
+            cursor = db.execute("UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = ? AND worker_id = ?",
+                                (time.time() + self.lease_s, job_id, RUNNING, worker_id))
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, result: dict, worker_id: str) -> bool:
+        return self._finish(job_id, worker_id, DONE, result=json.dumps(result))
+
+    def fail(self, job_id: str, error: str, worker_id: str) -> bool:
+        return self._finish(job_id, worker_id, FAILED, error=error)
+
+    def cancel(self, job_id: str):
+        with self._connect() as db:
+            db.execute("UPDATE jobs SET status = ?, lease_expires_at = NULL WHERE id = ? AND status IN (?, ?)",
+                       (CANCELLED, job_id, QUEUED, RUNNING))
+
+    def _finish(self, job_id: str, worker_id: str, status: str, result: str | None = None, error: str | None = None) -> bool:
+        with self._connect() as db:
+            # a cancelled job stays cancelled, and a worker whose lease was taken over has no say any more
+            cursor = db.execute("""UPDATE jobs SET status = ?, result = ?, error = ?, lease_expires_at = NULL
+                                   WHERE id = ? AND status = ? AND worker_id = ?""",
+                                (status, result, error, job_id, RUNNING, worker_id))
+        return cursor.rowcount == 1
+
+    def get(self, job_id: str) -> Job | None:
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return Job(row["id"], json.loads(row["payload"]), row["status"],
+                   json.loads(row["result"]) if row["result"] else None, row["error"], row["attempts"], row["worker_id"])
+
+    def purge(self, older_than_s: float) -> list[str]:
+        where, params = "status IN (?, ?, ?) AND created_at < ?", (DONE, FAILED, CANCELLED, time.time() - older_than_s)
+        db = self._connect()
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            job_ids = [row["id"] for row in db.execute(f"SELECT id FROM jobs WHERE {where}", params)]
+            db.execute(f"DELETE FROM jobs WHERE {where}", params)
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        finally:
+            db.close()
+        return job_ids
+
+class FileArtifactStore(ArtifactStore):
+    """Artifacts as files under root/<job id>/; put() is atomic, so readers never see partial files."""
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _job_dir(self, job_id: str) -> str:
+        uuid.UUID(job_id)  # keeps the path inside root
+        return os.path.join(self.root, job_id)
+
+    def put(self, job_id: str, name: str, source_path: str):
+        job_dir = self._job_dir(job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        destination = os.path.join(job_dir, os.path.basename(name))
+        tmp_destination = destination + ".tmp"
+        shutil.copyfile(source_path, tmp_destination)
+        os.replace(tmp_destination, destination)
+
+    def path(self, job_id: str, name: str) -> str:
+        return os.path.join(self._job_dir(job_id), os.path.basename(name))
+
+    def delete(self, job_id: str):
+        shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
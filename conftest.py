@@ -0,0 +1,17 @@
+import pytest
+from pydub.generators import WhiteNoise
+
+import drums
+
+SAMPLE_NUMBERS = [1, 2, *range(41, 47), 61, 62, *range(211, 216)]
+
+@pytest.fixture
+def drum_samples(tmp_path, monkeypatch):
+    """Placeholder drum samples in tmp_path/sounds, with tmp_path as the working directory."""
+    # 900 ms samples at 120 bpm ring well past the barline when hit late in the bar
+    (tmp_path / "sounds").mkdir()
+    for number in SAMPLE_NUMBERS:
+        WhiteNoise(sample_rate=22050).to_audio_segment(duration=900, volume=-30).export(
+            str(tmp_path / "sounds" / f"{number}.wav"), format="wav")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(drums, "_bar_variant_pools", {})
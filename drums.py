@@ -3,6 +3,14 @@ import random
 import drum_sounds as ds
 import sound_combiner as sc  # for sound combining functionality
 
+# Stem names used by the drum kit; each one gets its own track in the combiner
+KICK, RIDE, HIHAT, SNARE = "kick", "ride", "hihat", "snare"
+STEMS = (KICK, RIDE, HIHAT, SNARE)
+
+DEFAULT_BAR_VARIANTS = 16
+# (tempo, quarters per bar) -> pre-rendered bars, each a dict of stem name -> audio including the ringing tail
+_bar_variant_pools: dict[tuple[int, int], list[dict]] = {}
+
 class DrumPattern:
     def __init__(self, tempo=120, num_quarters=4):
         self.tempo = tempo
@@ -10,8 +18,9 @@ class DrumPattern:
         self.quarter_length = 1.0 / (self.tempo / 60)
         self.swing_factor = 0.67  # Not directly used in this create_pattern, but combiner might use it
         self.combiner = sc.AudioCombiner(self.tempo, self.num_quarters)
+        self.layout = None  # bar variant index per bar, set by create_pattern when tiling
 
-    def add(self, file_path, measure, quarter, multiplet_num=0, multiplet_din=3):
+    def add(self, file_path, measure, quarter, multiplet_num=0, multiplet_din=3, stem="main", combiner=None):
         """
         Adds a sound to the pattern.
         measure: 1-indexed measure number.
@@ -21,8 +30,10 @@ class DrumPattern:
                        - (quarter, 0, 2) for the first 8th (on the beat)
                        - (quarter, 1, 2) for the second 8th (the 'and')
                        Default (0,3) is for the first note of a triplet.
+        stem: name of the instrument track the sound goes to (see STEMS).
+        combiner: where to place the sound, self.combiner by default.
         """
-        self.combiner.place_at(file_path, measure, quarter, multiplet_num, multiplet_din)
+        (combiner or self.combiner).place_at(file_path, measure, quarter, multiplet_num, multiplet_din, stem=stem)
 
     def _get_placement_params(self, eighth_note_index_song):
         """
@@ -40,18 +51,56 @@ class DrumPattern:
         quarter = (eighth_note_in_bar / 2)
         return measure, quarter
 
-    def create_pattern(self, bars=4):
+    def create_pattern(self, bars=4, variants=DEFAULT_BAR_VARIANTS):
+        """
+        Fills self.combiner with `bars` bars of swing.
+        With variants > 0 the song is tiled from a cached pool of that many pre-rendered bars (see bar_variants),
+        so the cost per bar does not depend on how many hits it has. With variants=0 every hit is placed one by one.
+        """
+        if variants <= 0:
+            self.layout = None
+            for m in range(bars):
+                self._add_bar(m)
+            return
+        pool = self.bar_variants(variants)
+        self.layout = [random.randrange(len(pool)) for _ in range(bars)]
+        self.tile(self.layout, pool)
+
+    def bar_variants(self, count=DEFAULT_BAR_VARIANTS):
+        """
+        Returns `count` pre-rendered bars for this tempo and meter, rendering only the ones not cached yet.
+        Each bar is rendered on its own, so hits ringing past the barline stay in its tail.
+        """
+        pool = _bar_variant_pools.setdefault((self.tempo, self.num_quarters), [])
+        while len(pool) < count:
+            bar_combiner = sc.AudioCombiner(self.tempo, self.num_quarters)
+            self._add_bar(0, bar_combiner)
+            pool.append(dict(bar_combiner.stems))
+        return pool[:count]
+
+    def tile(self, layout, pool=None):
+        """Puts bar variant layout[i] at bar i of every stem; tails are summed into the following bars."""
+        pool = pool if pool is not None else self.bar_variants(max(layout, default=-1) + 1)
+        bar_ms = self.num_quarters * self.combiner.quarter_duration
+        offsets = [m * bar_ms for m in range(len(layout))]
+        for stem in STEMS:
+            segments = [pool[variant].get(stem) for variant in layout]
+            if any(seg is not None for seg in segments):
+                self.combiner.stems[stem] = sc.tile_segments(segments, offsets)
+            else:
+                self.combiner.stems.pop(stem, None)
+
+    def _add_bar(self, measure, combiner=None):
         # barlen_8th: number of 8th notes in a bar.
         # Assumes self.num_quarters defines the measure (e.g., 4 for 4/4 time).
-        barlen_8th = self.num_quarters * 2 
-        songlen_8th = bars * barlen_8th  # Total number of 8th notes in the song
+        barlen_8th = self.num_quarters * 2
 
         # Define sound generating functions from drum_sounds module
         bass_sound = ds.big_drum
         ride_sound = ds.ride1 
         hihat_sound = ds.c_hihats # Using c_hihats for typical closed hi-hat sounds
         snare_sound = ds.small_buzzle
-        for i in range(songlen_8th):  # i is the global 8th note index, 0-indexed
+        for i in range(measure * barlen_8th, (measure + 1) * barlen_8th):  # i is the global 8th note index, 0-indexed
             # Get placement parameters for the current 8th note i
             m, q = self._get_placement_params(i)
             mn = 0  # Multiplet number, default to 0
@@ -68,30 +117,30 @@ class DrumPattern:
                 q += self.swing_factor - 0.5  # Adjust for swing on syncopated beats
 
             if eighth_note_in_bar_0idx == 0: # Very first 8th note of the bar
-                self.add(bass_sound(), m, q, mn, md)
+                self.add(bass_sound(), m, q, mn, md, stem=KICK, combiner=combiner)
             if is_odd_beat_start: # Start of Q1, Q3
-                self.add(ride_sound(), m, q, mn, md)
+                self.add(ride_sound(), m, q, mn, md, stem=RIDE, combiner=combiner)
             
             if is_even_beat_start: # Start of Q2, Q4
-                self.add(ride_sound(), m, q, mn, md)
-                self.add(hihat_sound(), m, q, mn, md)
+                self.add(ride_sound(), m, q, mn, md, stem=RIDE, combiner=combiner)
+                self.add(hihat_sound(), m, q, mn, md, stem=HIHAT, combiner=combiner)
             
             if is_second_syncopation and random.random() < 0.9: # 'And' of Q2, 'And' of Q4
-                self.add(ride_sound(), m, q, mn, md)
+                self.add(ride_sound(), m, q, mn, md, stem=RIDE, combiner=combiner)
 
             # Snare on syncopated beats (general probability)
             if (is_first_syncopation or is_second_syncopation) and random.random() < 0.2:
-                self.add(snare_sound(), m, q, mn, md)
+                self.add(snare_sound(), m, q, mn, md, stem=SNARE, combiner=combiner)
             
             # Specific snare probabilities based on a new random roll
             rprob = random.random()
             if (is_first_syncopation or is_second_syncopation) and rprob < 0.05: # Double hit
                 qq = math.ceil(q)
-                self.add(snare_sound(), m, q, mn, md)
-                self.add(snare_sound(), m, qq, mn, md) # Add snare twice
+                self.add(snare_sound(), m, q, mn, md, stem=SNARE, combiner=combiner)
+                self.add(snare_sound(), m, qq, mn, md, stem=SNARE, combiner=combiner) # Add snare twice
 
             if (is_first_syncopation or is_second_syncopation) and 0.20 <= rprob <= 0.30:
-                self.add(snare_sound(), m, q, mn, md) 
+                self.add(snare_sound(), m, q, mn, md, stem=SNARE, combiner=combiner) 
 
 def main():
     pattern = DrumPattern(tempo=180, num_quarters=4) 
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the MuseScore executable, used by the load test harness (loadtest.py).
+Called the same way the app calls MuseScore:
+
+    fake_musescore.py <input.musicxml> -o <output.wav>
+
+It reads the note durations from the MusicXML file, sleeps for a configurable time
+and writes a deterministic WAV that is as long as the real render would be.
+Only the standard library is used, so it runs on any box with Python 3.
+
+Environment variables:
+    FAKE_MUSESCORE_DELAY              fixed delay in seconds (default 0.5)
+    FAKE_MUSESCORE_DELAY_PER_QUARTER  extra delay per quarter note in seconds (default 0)
+    FAKE_MUSESCORE_TEMPO              tempo used to compute the length (default 120, MuseScore's default)
+    FAKE_MUSESCORE_TAIL               seconds of release tail after the last note (default 0.5)
+"""
+import os
+import sys
+import time
+import wave
+import xml.etree.ElementTree as ET
+
+FRAME_RATE = 44100
+CHANNELS = 2
+TONE_HZ = 110  # one repeated cycle keeps the output deterministic and cheap to write
+
+def count_quarters(xml_path: str) -> float:
+    """Length of the longest part in quarter notes (chord tones and backups do not advance time)."""
+    root = ET.parse(xml_path).getroot()
+    longest = 0.0
+    for part in root.iter("part"):
+        divisions = 1
+        position = 0.0
+        for measure in part.iter("measure"):
+            for element in measure:
+                if element.tag == "attributes" and element.find("divisions") is not None:
+                    divisions = int(element.find("divisions").text)
+                elif element.tag == "note" and element.find("chord") is None and element.find("duration") is not None:
+                    position += int(element.find("duration").text) / divisions
+                elif element.tag == "backup":
+                    position -= int(element.find("duration").text) / divisions
+                elif element.tag == "forward":
+                    position += int(element.find("duration").text) / divisions
+        longest = max(longest, position)
+    return longest
+
+def write_wav(wav_path: str, seconds: float):
+    frames = int(seconds * FRAME_RATE)
+    period = FRAME_RATE // TONE_HZ
+    cycle = bytearray()
+    for i in range(period):
+        sample = (2000 if i < period // 2 else -2000).to_bytes(2, "little", signed=True)
+        cycle += sample * CHANNELS
+    frame_size = 2 * CHANNELS
+    data = bytes(cycle) * (frames // period + 1)
+    with wave.open(wav_path, "wb") as wav:
+        wav.setnchannels(CHANNELS)
+        wav.setsampwidth(2)
+        wav.setframerate(FRAME_RATE)
+        wav.writeframes(data[:frames * frame_size])
+
+def main(argv: list[str]) -> int:
+    if len(argv) != 4 or argv[2] != "-o":
+        print(f"usage: {argv[0]} <input.musicxml> -o <output.wav>", file=sys.stderr)
+        return 2
+    xml_path, wav_path = argv[1], argv[3]
+    tempo = float(os.environ.get("FAKE_MUSESCORE_TEMPO", "120"))
+    quarters = count_quarters(xml_path)
+    time.sleep(float(os.environ.get("FAKE_MUSESCORE_DELAY", "0.5"))
+               + quarters * float(os.environ.get("FAKE_MUSESCORE_DELAY_PER_QUARTER", "0")))
+    write_wav(wav_path, quarters * 60 / tempo + float(os.environ.get("FAKE_MUSESCORE_TAIL", "0.5")))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,308 @@
+"""
+Incremental re-rendering of an edited chart.
+A rendered session keeps, next to its stems (see StemMix.save), the expanded progression as one chord signature
+per bar, the bass walk, the drum layout and the final mix. An edit is diffed bar by bar against that state:
+the changed bars and the bar before each of them (its approach note leads into the change) get a new bass walk
+and a MuseScore render, inserted bars get new drum bars, and everything else is copied from the previous session,
+shifted when bars were inserted or deleted. Only the changed time range is mixed again; splice points are
+crossfaded over FADE_MS.
+"""
+import difflib
+import json
+import os
+import random
+from dataclasses import asdict, dataclass
+from typing import Callable
+
+import numpy as np
+from pydub import AudioSegment
+
+import bass_batch
+from drums import DEFAULT_BAR_VARIANTS, DrumPattern
+from sound_combiner import StemMix, segment_to_array, tile_segments
+
+STATE_FILE = "edit.json"
+MIX_FILE = "mix.npy"
+BASS_STEM = "bass"
+FADE_MS = 10
+
+@dataclass
+class SessionState:
+    bars: list[tuple]  # per bar: ((chord name, quarters), ...)
+    walk: list[int]  # bass MIDI numbers, one per quarter plus the final resolution note
+    layout: list[int]  # drum bar variant per bar (DrumPattern.layout)
+    tempo: int
+    quarters_per_bar: int
+
+    @classmethod
+    def from_render(cls, items, walk, layout, tempo: int, quarters_per_bar: int) -> "SessionState | None":
+        """State of a full render, or None when its bass or drums cannot be edited bar by bar."""
+        bars = [bar_signature(bar) for bar in split_bars(items, quarters_per_bar)]
+        walk = [int(midi) for midi in walk]
+        if not bars or layout is None or len(layout) != len(bars) or len(walk) != _quarters(bars) + 1:
+            return None
+        return cls(bars, walk, list(layout), tempo, quarters_per_bar)
+
+@dataclass
+class Edit:
+    state: SessionState
+    stems: StemMix
+    mixed: np.ndarray
+    bass_bars: int  # bars that got a new bass line
+    drum_bars: int  # bars that got new drums
+
+def split_bars(items, quarters_per_bar: int) -> list[list[bass_batch.ChordSpan]]:
+    """ChordSpans of an expanded progression (list(ChordProgression)), grouped into bars."""
+    bars, current, filled = [], [], 0
+    for span in bass_batch.spans_from_items(items):
+        current.append(span)
+        filled += span.quarters
+        if filled >= quarters_per_bar:
+            bars.append(current)
+            current, filled = [], 0
+    if current:
+        bars.append(current)
+    return bars
+
+def bar_signature(bar: list[bass_batch.ChordSpan]) -> tuple:
+    return tuple((str(span.chord), span.quarters) for span in bar)
+
+def _quarters(bars) -> int:
+    return sum(quarters for bar in bars for _, quarters in bar)
+
+def _bar_starts(bars) -> list[int]:
+    """Quarter at which every bar starts, plus the total."""
+    return np.concatenate([[0], np.cumsum([sum(quarters for _, quarters in bar) for bar in bars])]).astype(int).tolist()
+
+def save_state(directory: str, state: SessionState, mixed: np.ndarray):
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, MIX_FILE), mixed)
+    with open(os.path.join(directory, STATE_FILE), "w") as f:
+        json.dump(asdict(state), f)
+
+def load_state(directory: str) -> tuple[SessionState, StemMix, np.ndarray] | None:
+    """(state, stems, mixed samples) of a rendered session, or None if it was not saved with edit state."""
+    try:
+        with open(os.path.join(directory, STATE_FILE)) as f:
+            state = SessionState(**json.load(f))
+        mixed = np.load(os.path.join(directory, MIX_FILE), mmap_mode="r")
+        stems = StemMix.load(directory)
+    except (OSError, ValueError, TypeError):
+        return None
+    state.bars = [tuple(tuple(chord) for chord in bar) for bar in state.bars]
+    return state, stems, mixed
+
+def diff_bars(old_bars: list[tuple], new_bars: list[tuple]) -> list[tuple[str, int, int, int, int]]:
+    """
+    difflib opcodes turning old_bars into new_bars. The common head and tail are matched first: charts repeat
+    themselves, and on its own the matcher may align an unchanged stretch with an earlier repeat of it.
+    """
+    shortest = min(len(old_bars), len(new_bars))
+    head = 0
+    while head < shortest and old_bars[head] == new_bars[head]:
+        head += 1
+    tail = 0
+    while tail < shortest - head and old_bars[-1 - tail] == new_bars[-1 - tail]:
+        tail += 1
+    old_end, new_end = len(old_bars) - tail, len(new_bars) - tail
+    opcodes = [("equal", 0, head, 0, head)] if head else []
+    matcher = difflib.SequenceMatcher(None, old_bars[head:old_end], new_bars[head:new_end], autojunk=False)
+    opcodes += [(tag, i1 + head, i2 + head, j1 + head, j2 + head) for tag, i1, i2, j1, j2 in matcher.get_opcodes()]
+    if tail:
+        opcodes.append(("equal", old_end, len(old_bars), new_end, len(new_bars)))
+    return opcodes
+
+def plan_edit(old_bars: list[tuple], new_bars: list[tuple]) -> tuple[list[int | None], list[int | None]]:
+    """
+    Maps every new bar to the old bar it is copied from (None: render it), separately for bass and drums.
+    The bass keeps only unchanged bars whose next bar is unchanged too, as the approach note at the end of a bar
+    leads into the next one; a new first chord also renews the last bar, which leads back into it.
+    Drums do not depend on the chords: replaced bars keep their old drums, only inserted bars need new ones.
+    """
+    bass_map: list[int | None] = [None] * len(new_bars)
+    drum_map: list[int | None] = [None] * len(new_bars)
+    for tag, i1, i2, j1, j2 in diff_bars(old_bars, new_bars):
+        for k in range(j2 - j1):
+            if tag == "equal":
+                bass_map[j1 + k] = i1 + k
+            if i1 + k < i2:
+                drum_map[j1 + k] = i1 + k
+        if tag != "equal" and j1 > 0:
+            bass_map[j1 - 1] = None
+    if old_bars and new_bars and old_bars[0][:1] != new_bars[0][:1]:
+        bass_map[-1] = None
+    return bass_map, drum_map
+
+def runs(mapping: list[int | None]) -> list[tuple[int, int, int | None]]:
+    """(start, end, old start) of the maximal runs of new bars copied from consecutive old bars; old start None: rendered."""
+    result = []
+    for j, i in enumerate(mapping):
+        if result:
+            start, end, old_start = result[-1]
+            if (i is None and old_start is None) or (i is not None and old_start is not None and i == old_start + j - start):
+                result[-1] = (start, j + 1, old_start)
+                continue
+        result.append((j, j + 1, i))
+    return result
+
+class Splicer:
+    """Assembles sample rows of the new bars from runs of old bars and rendered runs."""
+    def __init__(self, bar_len: int, old_bar_count: int, channels: int, fade_frames: int):
+        self.bar_len = bar_len  # samples per bar (frames * channels)
+        self.old_bar_count = old_bar_count
+        self.fade = fade_frames * channels
+        self.fade_in = np.repeat(np.linspace(0, 1, fade_frames, endpoint=False, dtype=np.float32), channels)
+        self.fade_out = 1 - self.fade_in
+
+    def splice(self, old: np.ndarray, mapping: list[int | None], render: Callable[[int, int], np.ndarray]) -> np.ndarray:
+        """
+        Runs mapped to consecutive old bars are copied from `old` (with the old tail when they end on its last bar),
+        the others come from render(start bar, end bar), which may return samples past the run end (ringing notes).
+        At every boundary the left side's continuation fades out while the right side fades in.
+        """
+        pieces = []
+        all_runs = runs(mapping)
+        for k, (start, end, old_start) in enumerate(all_runs):
+            last = k == len(all_runs) - 1
+            nominal = (end - start) * self.bar_len
+            if old_start is None:
+                samples = render(start, end)
+                if last:
+                    nominal = max(nominal, samples.shape[1])
+            else:
+                a = old_start * self.bar_len
+                old_end = old_start + end - start
+                if last and old_end == self.old_bar_count:
+                    samples = old[:, a:]
+                    nominal = samples.shape[1]
+                else:
+                    samples = old[:, a:old_end * self.bar_len + self.fade]
+            pieces.append((samples, nominal))
+
+        last_samples, last_nominal = pieces[-1]
+        total = sum(nominal for _, nominal in pieces[:-1]) + max(last_nominal, last_samples.shape[1])
+        out = np.zeros((old.shape[0], total), dtype=old.dtype)
+        pos = 0
+        for k, (samples, nominal) in enumerate(pieces):
+            body = samples[:, :nominal]
+            out[:, pos:pos + body.shape[1]] = body
+            if k > 0:
+                previous, previous_nominal = pieces[k - 1]
+                self._crossfade(out, pos, previous[:, previous_nominal:previous_nominal + self.fade])
+            pos += nominal
+        continuation = last_samples[:, last_nominal:last_nominal + self.fade]
+        out[:, pos:pos + continuation.shape[1]] = self._clip(continuation * self.fade_out[:continuation.shape[1]], out.dtype)
+        return out
+
+    def _crossfade(self, out: np.ndarray, pos: int, continuation: np.ndarray):
+        n = min(self.fade, out.shape[1] - pos)
+        window = out[:, pos:pos + n].astype(np.float32) * self.fade_in[:n]
+        t = min(continuation.shape[1], n)
+        window[:, :t] += continuation[:, :t] * self.fade_out[:t]
+        out[:, pos:pos + n] = self._clip(window, out.dtype)
+
+    @staticmethod
+    def _clip(samples: np.ndarray, dtype) -> np.ndarray:
+        limit = np.iinfo(dtype)
+        return np.clip(np.rint(samples), limit.min, limit.max).astype(dtype)
+
+def _stack(rows: list[np.ndarray], dtype) -> np.ndarray:
+    stacked = np.zeros((len(rows), max((len(row) for row in rows), default=0)), dtype=dtype)
+    for target, row in zip(stacked, rows):
+        target[:len(row)] = row
+    return stacked
+
+def rerender(state: SessionState, stems: StemMix, mixed: np.ndarray | None, items,
+             render_bass: Callable[[list[int]], AudioSegment | None],
+             candidates: int = bass_batch.DEFAULT_CANDIDATES, rng: np.random.Generator | None = None) -> Edit | None:
+    """
+    Renders the expanded progression `items` as an edit of a session (state, stems and mixed samples, see load_state).
+    render_bass(midi numbers) renders one quarter note per number from time 0, at the stems' bass level.
+    Returns None when the progression has no bars.
+    """
+    new_spans = split_bars(items, state.quarters_per_bar)
+    new_bars = [bar_signature(bar) for bar in new_spans]
+    if not new_bars:
+        return None
+    n = len(new_bars)
+    bass_map, drum_map = plan_edit(state.bars, new_bars)
+    content_map = [None] * n  # unchanged bars, also those whose bass is renewed
+    for tag, i1, _, j1, j2 in diff_bars(state.bars, new_bars):
+        if tag == "equal":
+            content_map[j1:j2] = range(i1, i1 + j2 - j1)
+
+    # bass walk: copy the kept bars, then walk the renewed runs between their fixed neighbours
+    old_starts, new_starts = _bar_starts(state.bars), _bar_starts(new_bars)
+    old_walk = np.array(state.walk, dtype=np.int64)
+    walk = np.zeros(new_starts[-1] + 1, dtype=np.int64)
+    bass_runs = runs(bass_map)
+    for start, end, old_start in bass_runs:
+        if old_start is not None:
+            walk[new_starts[start]:new_starts[end]] = old_walk[old_starts[old_start]:old_starts[old_start + end - start]]
+    if bass_map[-1] is not None:
+        walk[-1] = old_walk[-1]
+    for start, end, old_start in bass_runs:
+        if old_start is None:
+            first = content_map[start]  # unchanged unless the run starts the song
+            walk_start = int(old_walk[old_starts[first]]) if first is not None else None
+            walk_end = int(walk[new_starts[end]]) if end < n else None
+            spans = [span for bar in new_spans[start:end] for span in bar]
+            line = bass_batch.best_walk(spans, candidates, walk_start, walk_end, rng)
+            walk[new_starts[start]:new_starts[end]] = line[:-1]
+            if end == n:
+                walk[-1] = line[-1]
+
+    # drums: replaced bars keep their variant, inserted bars get a random one
+    pattern = DrumPattern(tempo=state.tempo, num_quarters=state.quarters_per_bar)
+    pool = pattern.bar_variants(DEFAULT_BAR_VARIANTS) if None in drum_map else []
+    layout = [state.layout[i] if i is not None else random.randrange(len(pool)) for i in drum_map]
+
+    # stems: every stem the edit may need gets a row, then bass and drum rows are spliced separately
+    names = list(stems.names)
+    drum_names = [name for name in sorted({stem for variant in pool for stem in variant}) if name not in names]
+    names += drum_names + ([BASS_STEM] if BASS_STEM not in names else [])
+    fmt = (stems.frame_rate, stems.channels, stems.sample_width)
+    old_samples = np.asarray(stems.samples)
+    if len(names) > len(stems.names):
+        old_samples = np.vstack([old_samples, np.zeros((len(names) - len(stems.names), old_samples.shape[1]), old_samples.dtype)])
+    bar_ms = state.quarters_per_bar * 60000 / state.tempo
+    bar_len = round(bar_ms * stems.frame_rate / 1000) * stems.channels
+    splicer = Splicer(bar_len, len(state.bars), stems.channels, round(FADE_MS * stems.frame_rate / 1000))
+
+    def render_bass_run(start: int, end: int) -> np.ndarray:
+        notes = walk[new_starts[start]:new_starts[end]].tolist() + ([int(walk[-1])] if end == n else [])
+        segment = render_bass(notes)
+        return segment_to_array(segment, fmt)[None, :] if segment is not None else np.zeros((1, 0), old_samples.dtype)
+
+    drum_rows = [row for row, name in enumerate(names) if name != BASS_STEM]
+    def render_drum_run(start: int, end: int) -> np.ndarray:
+        offsets = [m * bar_ms for m in range(end - start)]
+        segments = [tile_segments([pool[variant].get(names[row]) for variant in layout[start:end]], offsets) for row in drum_rows]
+        return _stack([segment_to_array(segment, fmt) for segment in segments], old_samples.dtype)
+
+    bass_row = names.index(BASS_STEM)
+    spliced_bass = splicer.splice(old_samples[bass_row:bass_row + 1], bass_map, render_bass_run)
+    spliced_drums = splicer.splice(old_samples[drum_rows], drum_map, render_drum_run)
+    samples = np.zeros((len(names), max(spliced_bass.shape[1], spliced_drums.shape[1])), dtype=old_samples.dtype)
+    samples[bass_row, :spliced_bass.shape[1]] = spliced_bass[0]
+    samples[drum_rows, :spliced_drums.shape[1]] = spliced_drums
+    new_stems = StemMix(names, samples, *fmt)
+
+    # mix: bars whose bass and drums are copied with the same shift keep their old mixed samples
+    if mixed is None:
+        new_mixed = new_stems.mix_samples()
+    else:
+        combined_map = [b if b == d else None for b, d in zip(bass_map, drum_map)]
+        mix_splicer = Splicer(bar_len, len(state.bars), stems.channels, 0)
+        def mix_run(start: int, end: int) -> np.ndarray:
+            return new_stems.mix_samples(start=start * bar_len, end=None if end == n else end * bar_len)[None, :]
+        new_mixed = mix_splicer.splice(np.asarray(mixed)[None, :], combined_map, mix_run)[0][:samples.shape[1]]
+        for start, _, old_start in runs(combined_map)[1:]:
+            if old_start is not None:  # the crossfades at the start of a copied run changed the stems there
+                window = slice(start * bar_len, start * bar_len + splicer.fade)
+                new_mixed[window] = new_stems.mix_samples(start=window.start, end=window.stop)
+        if len(new_mixed) < samples.shape[1]:
+            new_mixed = np.concatenate([new_mixed, new_stems.mix_samples(start=len(new_mixed))])
+
+    new_state = SessionState(new_bars, walk.tolist(), layout, state.tempo, state.quarters_per_bar)
+    return Edit(new_state, new_stems, new_mixed, bass_map.count(None), drum_map.count(None))
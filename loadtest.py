@@ -0,0 +1,290 @@
+"""
+Offline load test for the /generate_jazz_composition/ endpoint.
+
+Starts the app under uvicorn in a scratch directory, with fake_musescore.py in place of MuseScore,
+fires a mix of chart sizes at a fixed concurrency and reports latency percentiles,
+throughput, error rate and the RSS of the server processes. Needs no network and no MuseScore:
+
+    python loadtest.py --workers 2 --concurrency 8 --requests 200 --sizes 4,16,64
+
+If sounds/ is missing from the repository, placeholder drum samples are generated in the scratch directory.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import wave
+from concurrent.futures import ThreadPoolExecutor
+
+import drum_sounds as ds
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKE_MUSESCORE = os.path.join(REPO_DIR, "fake_musescore.py")
+ENDPOINT = "/generate_jazz_composition/"
+
+# Bars cycled to build charts of any size; every line is one 4/4 bar
+CHART_BARS = ["Dm7 G7", "Cmaj7", "Am7 D7", "Gm7 C7", "Fmaj7", "Bb7 Bdim7", "Em7 A7", "D7b9"]
+
+def make_chart(bars: int, seed: int = 0) -> str:
+    """A chart of `bars` bars; different seeds give different charts, so the server cannot coalesce the requests."""
+    return "\n".join(random.Random(seed).choices(CHART_BARS, k=bars))
+
+def drum_sample_names() -> list[str]:
+    """Every file name the drum_sounds constants can produce."""
+    names = set()
+    for drum in vars(ds).values():
+        if not isinstance(drum, ds.Drum):
+            continue
+        if isinstance(drum.sound_spec, int):
+            names.add(f"{drum.sound_spec}.wav")
+            continue
+        choices = []
+        for element in drum.sound_spec:
+            if isinstance(element, int):
+                choices.append([element])
+            elif isinstance(element, tuple):
+                choices.append(range(element[0], element[1] + 1))
+            elif isinstance(element, list):
+                choices.append(element)
+        for combination in itertools.product(*choices):
+            names.add("_".join(str(part) for part in combination) + ".wav")
+    return sorted(names)
+
+def write_placeholder_sample(path: str, seed: int, duration: float = 0.3, frame_rate: int = 44100):
+    rng = random.Random(seed)
+    frames = int(duration * frame_rate)
+    data = bytearray()
+    for i in range(frames):
+        amplitude = 8000 * math.exp(-12 * i / frame_rate)
+        data += int(amplitude * (rng.random() * 2 - 1)).to_bytes(2, "little", signed=True)
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(frame_rate)
+        wav.writeframes(bytes(data))
+
+def prepare_workdir(workdir: str):
+    shutil.copy(os.path.join(REPO_DIR, "form.html"), workdir)
+    repo_sounds = os.path.join(REPO_DIR, "sounds")
+    if os.path.isdir(repo_sounds):
+        os.symlink(repo_sounds, os.path.join(workdir, "sounds"))
+        return
+    print("sounds/ not found in the repository, generating placeholder drum samples.")
+    os.makedirs(os.path.join(workdir, "sounds"))
+    for seed, name in enumerate(drum_sample_names()):
+        write_placeholder_sample(os.path.join(workdir, "sounds", name), seed)
+
+def wait_for_port(port: int, server: subprocess.Popen, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode} before accepting connections.")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not start listening on port {port} within {timeout} s.")
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def process_tree(root_pid: int) -> list[int]:
+    parents = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the command name may contain spaces, fields after it are fixed
+                parents[int(entry)] = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    tree = [root_pid]
+    for pid in tree:
+        tree.extend(child for child, parent in parents.items() if parent == pid)
+    return tree
+
+def rss_kib(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def is_server_process(pid: int) -> bool:
+    """Server processes only: the short-lived fake MuseScore children are not workers."""
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            return b"fake_musescore" not in f.read()
+    except OSError:
+        return False
+
+class RssMonitor(threading.Thread):
+    def __init__(self, root_pid: int, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self.interval = interval
+        self.peak: dict[int, int] = {}
+        self.last: dict[int, int] = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def sample(self):
+        for pid in process_tree(self.root_pid):
+            if not is_server_process(pid):
+                continue
+            rss = rss_kib(pid)
+            if rss:
+                self.last[pid] = rss
+                self.peak[pid] = max(self.peak.get(pid, 0), rss)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def send_request(url: str, bars: int, timeout: float, seed: int = 0) -> dict:
+    body = urllib.parse.urlencode({"chord_progression": make_chart(bars, seed)}).encode()
+    started = time.perf_counter()
+    status, error, size = 0, None, 0
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=body), timeout=timeout) as response:
+            status = response.status
+            size = len(response.read())
+    except urllib.error.HTTPError as e:
+        status, error = e.code, e.read().decode(errors="replace")[:200]
+    except (urllib.error.URLError, OSError) as e:
+        error = str(e)
+    return {"bars": bars, "status": status, "error": error, "bytes": size,
+            "latency": time.perf_counter() - started}
+
+def summarize(results: list[dict], elapsed: float) -> dict:
+    latencies = [r["latency"] for r in results if r["status"] == 200]
+    errors = [r for r in results if r["status"] != 200]
+    summary = {
+        "requests": len(results),
+        "errors": len(errors),
+        "error_rate": len(errors) / len(results) if results else 0.0,
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_s": {f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+        "by_size": {},
+    }
+    for bars in sorted({r["bars"] for r in results}):
+        sized = [r for r in results if r["bars"] == bars]
+        ok = [r["latency"] for r in sized if r["status"] == 200]
+        summary["by_size"][bars] = {"requests": len(sized), "errors": len(sized) - len(ok),
+                                    "p50_s": percentile(ok, 50), "p95_s": percentile(ok, 95)}
+    if errors:
+        summary["first_error"] = {"status": errors[0]["status"], "error": errors[0]["error"]}
+    return summary
+
+def print_report(summary: dict, monitor: RssMonitor):
+    lat = summary["latency_s"]
+    print(f"\nRequests: {summary['requests']}, errors: {summary['errors']} ({summary['error_rate']:.1%})")
+    print(f"Elapsed: {summary['elapsed_s']:.1f} s, throughput: {summary['throughput_rps']:.2f} req/s")
+    print(f"Latency: p50 {lat['p50']:.3f} s, p95 {lat['p95']:.3f} s, p99 {lat['p99']:.3f} s")
+    print(f"\n{'bars':>6} {'requests':>9} {'errors':>7} {'p50 s':>8} {'p95 s':>8}")
+    for bars, row in summary["by_size"].items():
+        print(f"{bars:>6} {row['requests']:>9} {row['errors']:>7} {row['p50_s']:>8.3f} {row['p95_s']:>8.3f}")
+    print(f"\n{'pid':>8} {'peak RSS MiB':>13} {'last RSS MiB':>13}")
+    for pid in sorted(monitor.peak):
+        print(f"{pid:>8} {monitor.peak[pid] / 1024:>13.1f} {monitor.last.get(pid, 0) / 1024:>13.1f}")
+    if "first_error" in summary:
+        print(f"\nFirst error: {summary['first_error']}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight at once")
+    parser.add_argument("--requests", type=int, default=50, help="total number of requests")
+    parser.add_argument("--sizes", default="4,16,64", help="chart sizes in bars, comma separated")
+    parser.add_argument("--weights", default=None, help="relative frequency of each size (default: equal)")
+    parser.add_argument("--delay", type=float, default=0.5, help="fake MuseScore fixed delay, seconds")
+    parser.add_argument("--delay-per-quarter", type=float, default=0.0, help="fake MuseScore delay per quarter note, seconds")
+    parser.add_argument("--timeout", type=float, default=300.0, help="per-request timeout, seconds")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the request mix")
+    parser.add_argument("--json", dest="json_path", help="also write the summary as JSON to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory with the server log")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    weights = [float(w) for w in args.weights.split(",")] if args.weights else None
+    mix = random.Random(args.seed).choices(sizes, weights=weights, k=args.requests)
+
+    workdir = tempfile.mkdtemp(prefix="jazzcomp_loadtest_")
+    prepare_workdir(workdir)
+    port = free_port()
+    env = dict(os.environ,
+               JAZZCOMP_MUSESCORE=FAKE_MUSESCORE,
+               FAKE_MUSESCORE_DELAY=str(args.delay),
+               FAKE_MUSESCORE_DELAY_PER_QUARTER=str(args.delay_per_quarter))
+    log_path = os.path.join(workdir, "server.log")
+    with open(log_path, "w") as log:
+        server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app:app", "--app-dir", REPO_DIR,
+                                   "--host", "127.0.0.1", "--port", str(port), "--workers", str(args.workers)],
+                                  cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    monitor = RssMonitor(server.pid)
+    try:
+        wait_for_port(port, server)
+        print(f"Server up on port {port} with {args.workers} worker(s); sending {args.requests} requests "
+              f"at concurrency {args.concurrency}, sizes {sizes}.")
+        monitor.start()
+        url = f"http://127.0.0.1:{port}{ENDPOINT}"
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            results = list(pool.map(lambda n: send_request(url, mix[n], args.timeout, args.seed + n), range(len(mix))))
+        elapsed = time.perf_counter() - started
+        monitor.stop()
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    summary = summarize(results, elapsed)
+    summary["rss_kib"] = {"peak": monitor.peak, "last": monitor.last}
+    print_report(summary, monitor)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(summary, f, indent=2)
+    if args.keep:
+        print(f"\nScratch directory kept at {workdir} (server log: {log_path})")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 1 if summary["errors"] == len(results) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -37,6 +37,6 @@ subprocess.run([msc_path, 'test_bass_line.xml', '-o', 'test_bass_line.wav'], che
 
 drums = DrumPattern(tempo=120, num_quarters=4)
 drums.create_pattern(12)
-drums.combiner.place_at('test_bass_line.wav', 0, 0, volume_step=10.0)  # Place bass line in measure 1, quarter 1
+drums.combiner.place_at('test_bass_line.wav', 0, 0, volume_step=10.0, stem="bass")  # Place bass line in measure 1, quarter 1
 # Comping WAV addition to combiner completely removed.
 drums.combiner.export('test_song_with_drums.wav')
\ No newline at end of file
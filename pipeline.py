@@ -0,0 +1,200 @@
+"""
+The render pipeline: parse -> bass -> MuseScore -> drums -> mix.
+Shared by the web app (app.py), which renders in-process, and render workers (worker.py), which take jobs from a broker.
+"""
+import os
+import shutil # For cleaning up old stems
+import subprocess
+import time
+import uuid
+
+from pydub import AudioSegment
+
+import bass_batch
+import incremental
+from bass import ChordProgression
+from drums import DrumPattern
+from sound_combiner import array_to_segment
+from music21 import stream, note as m21_note, instrument, environment
+
+# Setup Constants and Directories
+# JAZZCOMP_MUSESCORE overrides music21's setting, e.g. to point at fake_musescore.py for load tests
+msc_path = os.environ.get("JAZZCOMP_MUSESCORE") or environment.get("musicxmlPath")
+if not msc_path:
+    print("Warning: MuseScore path not found in music21 environment. WAV generation will fail.")
+
+# Everything the app and the workers write; must be shared storage when they run on different hosts
+TEMP_BASE_DIR = os.environ.get("JAZZCOMP_TEMP_DIR", "temp_audio_FastAPI")
+os.makedirs(TEMP_BASE_DIR, exist_ok=True)
+
+# Stems of recent sessions are kept here so /remix/ can rebalance them without re-rendering.
+# A 512-bar session is about 1 GB, so the cache is bounded by total size and by age rather than by session count.
+STEMS_DIR = os.path.join(TEMP_BASE_DIR, "stems")
+os.makedirs(STEMS_DIR, exist_ok=True)
+STEMS_MAX_BYTES = int(float(os.environ.get("JAZZCOMP_STEMS_MAX_MB", "4096")) * 1024 * 1024)
+STEMS_MAX_AGE_S = float(os.environ.get("JAZZCOMP_STEMS_MAX_AGE_S", "3600"))
+BASS_STEM = incremental.BASS_STEM
+BASS_GAIN_DB = 10.0
+# Number of candidate bass lines scored per request (bass_batch); 0 falls back to a single random walk
+BASS_CANDIDATES = int(os.environ.get("JAZZCOMP_BASS_CANDIDATES", "64"))
+
+TEMPO = 120
+QUARTERS_PER_BAR = 4
+
+def _mtime_or_zero(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:  # removed by a concurrent prune
+        return 0.0
+
+def _session_bytes(path: str) -> int:
+    try:
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    except OSError:
+        return 0
+
+def prune_stem_sessions(stems_dir: str = STEMS_DIR, max_bytes: int = STEMS_MAX_BYTES, max_age_s: float = STEMS_MAX_AGE_S):
+    """
+    Removes sessions older than max_age_s, then the oldest ones until the rest fit into max_bytes.
+    The newest session is always kept, it is the one that was just rendered.
+    """
+    sessions = [os.path.join(stems_dir, name) for name in os.listdir(stems_dir)]
+    sessions.sort(key=_mtime_or_zero, reverse=True)
+    now = time.time()
+    total = 0
+    for i, session in enumerate(sessions):
+        total += _session_bytes(session)
+        if i > 0 and (total > max_bytes or now - _mtime_or_zero(session) > max_age_s):
+            shutil.rmtree(session, ignore_errors=True)
+
+def render_bass(notes, xml_path: str, wav_path: str) -> bool:
+    """Writes the bass notes as MusicXML and renders it with MuseScore; False if there was nothing to render."""
+    bass_stream = stream.Stream()
+    bass_stream.insert(0, instrument.AcousticBass())
+    for note_obj in notes:
+        m21_note_obj = m21_note.Note(note_obj.to_midi())
+        m21_note_obj.duration.quarterLength = note_obj.length/2
+        bass_stream.append(m21_note_obj)
+    if len(bass_stream) <= 1:  # only the instrument
+        return False
+    bass_stream.write('musicxml', fp=xml_path)
+    subprocess.run([msc_path, xml_path, '-o', wav_path], check=True, capture_output=True)
+    return True
+
+def render_composition(chord_progression: str, session_id: str, session_temp_dir: str, base_session_id: str | None = None) -> str:
+    """
+    Runs the whole pipeline (parse -> bass -> MuseScore -> drums -> mix) and returns the final WAV path.
+    With base_session_id the chart is rendered as an edit of that session, re-rendering only the changed bars
+    (see incremental.py), if that session is still cached.
+    """
+    if base_session_id:
+        final_wav_path = render_edit(chord_progression, session_id, session_temp_dir, base_session_id)
+        if final_wav_path is not None:
+            return final_wav_path
+        print(f"Session {session_id}: Session {base_session_id} cannot be edited, rendering the whole chart.")
+
+    bass_xml_path = os.path.join(session_temp_dir, "bass_line.xml")
+    bass_wav_path = os.path.join(session_temp_dir, "bass_line.wav")
+    final_wav_path = os.path.join(session_temp_dir, "final_composition.wav")
+
+    # 1. Parse Chord Progression
+    print(f"Session {session_id}: Parsing chord progression:\n{chord_progression}")
+    prog = ChordProgression.from_string(chord_progression, default_bar_length_quarters=QUARTERS_PER_BAR)
+
+    # 2. Generate Bass Line
+    print(f"Session {session_id}: Generating bass line...")
+    bassline_notes = prog.generate_best_bass_line(BASS_CANDIDATES) if BASS_CANDIDATES > 0 else prog.generate_bass_line()
+
+    print(f"Session {session_id}: Converting bass to WAV at {bass_wav_path} using {msc_path}")
+    if render_bass(bassline_notes, bass_xml_path, bass_wav_path):
+        print(f"Session {session_id}: Bass WAV generated.")
+    else:
+        print(f"Session {session_id}: Bass stream empty or invalid, skipping WAV generation for bass.")
+
+
+
+    # 4. Generate Drums and Combine
+    print(f"Session {session_id}: Generating drums and combining audio...")
+    expanded_prog_items = list(prog)
+    total_quarters = sum(item.duration for item in expanded_prog_items if item.is_chord and hasattr(item, 'duration'))
+
+    num_bars = (int(total_quarters) + QUARTERS_PER_BAR - 1) // QUARTERS_PER_BAR
+    if num_bars == 0 and total_quarters > 0 : num_bars = 1
+    if num_bars == 0:
+        print(f"Session {session_id}: No calculable bars from progression, defaulting to 4 bars for drums.")
+        num_bars = 4
+
+    print(f"Session {session_id}: Calculated {total_quarters} total quarters, resulting in {num_bars} bars for drums.")
+
+    drum_machine = DrumPattern(tempo=TEMPO, num_quarters=QUARTERS_PER_BAR)
+    drum_machine.create_pattern(bars=num_bars)
+    print(f"Session {session_id}: Drum pattern created with stems {list(drum_machine.combiner.stems)}.")
+
+    if os.path.exists(bass_wav_path):
+        print(f"Session {session_id}: Adding bass WAV to drum combiner.")
+        drum_machine.combiner.place_at(bass_wav_path, 0, 0, volume_step=BASS_GAIN_DB, stem=BASS_STEM)
+    else:
+        print(f"Session {session_id}: Bass WAV not found at {bass_wav_path}, not adding to mix.")
+
+    stem_mix = drum_machine.combiner.stem_mix()
+    mixed = stem_mix.mix_samples()
+    stem_dir = os.path.join(STEMS_DIR, session_id)
+    stem_mix.save(stem_dir)
+    # the batch walk has one note per quarter, so later edits of this chart can be rendered bar by bar
+    state = None
+    if BASS_CANDIDATES > 0:
+        state = incremental.SessionState.from_render(expanded_prog_items, [n.to_midi() for n in bassline_notes],
+                                                     drum_machine.layout, TEMPO, QUARTERS_PER_BAR)
+    if state is not None:
+        incremental.save_state(stem_dir, state, mixed)
+    prune_stem_sessions()
+    print(f"Session {session_id}: Stems {stem_mix.names} cached for remixing{' and editing' if state else ''}.")
+
+    print(f"Session {session_id}: Exporting final combined audio to {final_wav_path}")
+    array_to_segment(mixed, (stem_mix.frame_rate, stem_mix.channels, stem_mix.sample_width)).export(final_wav_path, format="wav")
+    print(f"Session {session_id}: Final WAV exported.")
+    return final_wav_path
+
+def render_edit(chord_progression: str, session_id: str, session_temp_dir: str, base_session_id: str) -> str | None:
+    """Renders the chart as an edit of base_session_id (see incremental.py); None if that session cannot be edited."""
+    try:
+        uuid.UUID(base_session_id)  # also keeps the path inside STEMS_DIR
+    except ValueError:
+        return None
+    loaded = incremental.load_state(os.path.join(STEMS_DIR, base_session_id))
+    if loaded is None or BASS_CANDIDATES <= 0:
+        return None
+    state, old_stems, old_mixed = loaded
+    if (state.tempo, state.quarters_per_bar) != (TEMPO, QUARTERS_PER_BAR):
+        return None
+
+    print(f"Session {session_id}: Parsing chord progression as an edit of session {base_session_id}:\n{chord_progression}")
+    prog = ChordProgression.from_string(chord_progression, default_bar_length_quarters=QUARTERS_PER_BAR)
+    bass_renders = []
+
+    def render_bass_notes(midi_numbers: list[int]) -> AudioSegment | None:
+        part = len(bass_renders)
+        xml_path = os.path.join(session_temp_dir, f"bass_part_{part}.xml")
+        wav_path = os.path.join(session_temp_dir, f"bass_part_{part}.wav")
+        bass_renders.append(len(midi_numbers))
+        if not render_bass(bass_batch.to_notes(midi_numbers), xml_path, wav_path):
+            return None
+        return AudioSegment.from_file(wav_path) + BASS_GAIN_DB
+
+    edit = incremental.rerender(state, old_stems, old_mixed, list(prog), render_bass_notes, BASS_CANDIDATES)
+    if edit is None:
+        return None
+    print(f"Session {session_id}: New bass for {edit.bass_bars} and new drums for {edit.drum_bars} "
+          f"of {len(edit.state.bars)} bars ({sum(bass_renders)} notes through MuseScore).")
+
+    stem_dir = os.path.join(STEMS_DIR, session_id)
+    edit.stems.save(stem_dir)
+    incremental.save_state(stem_dir, edit.state, edit.mixed)
+    prune_stem_sessions()
+
+    final_wav_path = os.path.join(session_temp_dir, "final_composition.wav")
+    print(f"Session {session_id}: Exporting final combined audio to {final_wav_path}")
+    stems = edit.stems
+    array_to_segment(edit.mixed, (stems.frame_rate, stems.channels, stems.sample_width)).export(final_wav_path, format="wav")
+    print(f"Session {session_id}: Final WAV exported.")
+    return final_wav_path
@@ -0,0 +1,147 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# tracemalloc is global to the process: its peak and its start/stop are shared by every profiler, so profilers
+# that trace allocations take turns. A profiled request waits here for the previous one to finish.
+_allocation_tracing = threading.Lock()
+
+class RequestProfiler:
+    """
+    Sampling profiler for a single request.
+    A background thread records the call stack of the thread that called start() every `interval` seconds,
+    so time spent waiting on subprocesses (MuseScore) shows up as well as pure Python work.
+    With trace_allocations, tracemalloc records where memory was allocated while the profiler ran.
+    Nothing is installed until start() is called, so an unused profiler costs nothing.
+    Profilers tracing allocations run one at a time in the process (start() waits for the running one to stop).
+    """
+    def __init__(self, interval: float = 0.005, top_n: int = 25, trace_allocations: bool = True):
+        self.interval = interval
+        self.top_n = top_n
+        self.trace_allocations = trace_allocations
+        self.stacks: Counter[str] = Counter()
+        self.wall_time = 0.0
+        self.peak_memory = 0
+        self.allocations: list[tracemalloc.Statistic] = []
+        self._thread_id: int | None = None
+        self._stop_event = threading.Event()
+        self._sampler: threading.Thread | None = None
+        self._owns_tracemalloc = False
+        self._started_at = 0.0
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._stop_event.clear()
+        if self.trace_allocations:
+            _allocation_tracing.acquire()
+            # tracing may have been started outside any profiler (PYTHONTRACEMALLOC); then it is left running
+            self._owns_tracemalloc = not tracemalloc.is_tracing()
+            if self._owns_tracemalloc:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        self._started_at = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample, name="request-profiler", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+        self.wall_time = time.perf_counter() - self._started_at
+        if self.trace_allocations:
+            try:
+                self.peak_memory = tracemalloc.get_traced_memory()[1]
+                snapshot = tracemalloc.take_snapshot().filter_traces([
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, __file__),
+                ])
+                self.allocations = snapshot.statistics("lineno")[:self.top_n]
+                if self._owns_tracemalloc:
+                    tracemalloc.stop()
+            finally:
+                _allocation_tracing.release()
+
+    def __enter__(self) -> "RequestProfiler":
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _sample(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def collapsed(self) -> str:
+        """Stacks in the collapsed format read by flamegraph.pl, speedscope and similar tools."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self) -> str:
+        total = sum(self.stacks.values()) or 1
+        own: Counter[str] = Counter()
+        inclusive: Counter[str] = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+
+        lines = [f"Wall time: {self.wall_time * 1000:.1f} ms, {total} samples every {self.interval * 1000:.1f} ms"]
+        lines.append("")
+        lines.append(f"{'own %':>7} {'total %':>8}  function")
+        for frame, count in own.most_common(self.top_n):
+            lines.append(f"{100 * count / total:6.1f}% {100 * inclusive[frame] / total:7.1f}%  {frame}")
+        if self.trace_allocations:
+            lines.append("")
+            # tracemalloc cannot tell threads apart: renders of other requests running meanwhile are counted too
+            lines.append(f"Peak traced memory: {self.peak_memory / 1024:.1f} KiB; live allocations by line "
+                         f"(whole process, including other requests running at the same time):")
+            for stat in self.allocations:
+                frame = stat.traceback[0]
+                lines.append(f"{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {frame.filename}:{frame.lineno}")
+        return "\n".join(lines) + "\n"
+
+    def save(self, directory: str, name: str) -> tuple[str, str]:
+        """Writes <name>.collapsed and <name>.txt into directory and returns their paths."""
+        os.makedirs(directory, exist_ok=True)
+        collapsed_path = os.path.join(directory, f"{name}.collapsed")
+        summary_path = os.path.join(directory, f"{name}.txt")
+        with open(collapsed_path, "w") as f:
+            f.write(self.collapsed())
+        with open(summary_path, "w") as f:
+            f.write(self.summary())
+        return collapsed_path, summary_path
+
+def prune_reports(directory: str, max_count: int = 100, max_age_s: float = 86400.0):
+    """Keeps the newest max_count reports written by RequestProfiler.save and removes any older than max_age_s."""
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return
+    reports: dict[str, float] = {}
+    for entry in entries:
+        name = os.path.splitext(entry.name)[0]
+        try:
+            reports[name] = max(reports.get(name, 0.0), entry.stat().st_mtime)
+        except FileNotFoundError:
+            continue
+    now = time.time()
+    newest_first = sorted(reports, key=reports.get, reverse=True)
+    for i, name in enumerate(newest_first):
+        if i >= max_count or now - reports[name] > max_age_s:
+            for extension in ("collapsed", "txt"):
+                try:
+                    os.remove(os.path.join(directory, f"{name}.{extension}"))
+                except FileNotFoundError:
+                    pass
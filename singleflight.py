@@ -0,0 +1,163 @@
+"""
+Single-flight deduplication of identical renders.
+Requests with the same key share one render: within a worker they await the same future,
+across workers (processes) the first one takes an flock on <key>.lock and the others poll for its
+done marker without holding render budget. Only renders still running when a request arrives are shared:
+a finished result is never served to a later request, and ttl_s only has to cover the followers picking it up.
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, replace
+from typing import Awaitable, Callable
+
+MARKER = "done.json"  # <key>.done.json points at the result directory <key>.<render id>
+
+def normalize_chart(text: str) -> str:
+    """Chart text without what from_string ignores: blank and '@' lines, surrounding and repeated whitespace."""
+    lines = (" ".join(raw_line.split()) for raw_line in text.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("@"))
+
+def request_key(chart: str, **params) -> str:
+    payload = json.dumps({"chart": normalize_chart(chart), "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+@dataclass
+class SharedResult:
+    result_dir: str
+    meta: dict
+    shared: bool  # False only for the request that actually rendered
+
+class SingleFlight:
+    def __init__(self, base_dir: str, ttl_s: float = 5.0, poll_interval_s: float = 0.1, wait_timeout_s: float = 300.0):
+        self.base_dir = base_dir
+        self.ttl_s = ttl_s
+        self.poll_interval_s = poll_interval_s
+        self.wait_timeout_s = wait_timeout_s
+        self._inflight: dict[str, asyncio.Future] = {}
+        os.makedirs(base_dir, exist_ok=True)
+
+    async def run(self, key: str, render: Callable[[str], Awaitable[dict]]) -> SharedResult:
+        """
+        Returns the result for `key`, calling render(result_dir) only if no other request is rendering it.
+        render writes its output into result_dir and returns JSON-serializable metadata.
+        """
+        if key in self._inflight:
+            return replace(await asyncio.shield(self._inflight[key]), shared=True)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._run_across_workers(key, render)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # the followers, if any, re-raise it; without them it must not be reported as lost
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def _run_across_workers(self, key: str, render: Callable[[str], Awaitable[dict]]) -> SharedResult:
+        self.sweep()
+        arrived_at = time.time()
+        deadline = time.monotonic() + self.wait_timeout_s
+        while True:
+            lock_file = open(os.path.join(self.base_dir, f"{key}.lock"), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another worker is rendering the same request
+                lock_file.close()
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Waited more than {self.wait_timeout_s:.0f} s for an identical render.")
+                await asyncio.sleep(self.poll_interval_s)
+                continue
+            try:
+                # only a render that finished after we arrived: the one we waited for, or one that finished
+                # between our arrival and the lock. An earlier result, even if the render after it failed, is not ours
+                shared = self._read_marker(key, arrived_at)
+                if shared is not None:
+                    return shared
+                # every render gets its own directory, so followers still linking the previous result keep it
+                result_dir = os.path.join(self.base_dir, f"{key}.{uuid.uuid4().hex[:12]}")
+                os.makedirs(result_dir)
+                try:
+                    meta = await render(result_dir)
+                except BaseException:
+                    shutil.rmtree(result_dir, ignore_errors=True)
+                    raise
+                self._write_marker(key, result_dir, meta)
+                return SharedResult(result_dir, meta, False)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+    def _read_marker(self, key: str, finished_after: float | None = None) -> SharedResult | None:
+        marker = os.path.join(self.base_dir, f"{key}.{MARKER}")
+        try:
+            if time.time() - os.path.getmtime(marker) > self.ttl_s:
+                return None
+            with open(marker) as f:
+                done = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # time.time() recorded by the renderer: file mtimes are too coarse to order against an arrival time
+        if finished_after is not None and done["finished_at"] < finished_after:
+            return None
+        return SharedResult(os.path.join(self.base_dir, done["dir"]), done["meta"], True)
+
+    def _write_marker(self, key: str, result_dir: str, meta: dict):
+        marker = os.path.join(self.base_dir, f"{key}.{MARKER}")
+        with open(marker + ".tmp", "w") as f:
+            json.dump({"dir": os.path.basename(result_dir), "meta": meta, "finished_at": time.time()}, f)
+        os.replace(marker + ".tmp", marker)  # readers never see a half-written marker
+
+    def sweep(self):
+        """Removes results, markers and lock files that are older than ttl_s."""
+        now = time.time()
+        for name in os.listdir(self.base_dir):
+            key = name.split(".")[0]
+            path = os.path.join(self.base_dir, name)
+            if name.endswith(".lock") or key in self._inflight:
+                continue
+            try:
+                expired = now - os.path.getmtime(path) > self.ttl_s
+            except OSError:
+                continue
+            lock_path = os.path.join(self.base_dir, f"{key}.lock")
+            if not expired or self._is_locked(lock_path):
+                continue
+            if os.path.isdir(path):
+                current = self._read_marker(key)
+                if current is None or current.result_dir != path:  # a fresh marker may still be read
+                    shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                os.remove(path)
+                if name == f"{key}.{MARKER}":
+                    os.remove(lock_path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _is_locked(lock_path: str) -> bool:
+        """True while some worker is rendering under this lock file (slow renders may outlive the TTL)."""
+        try:
+            fd = os.open(lock_path, os.O_RDWR)  # no O_CREAT: checking must not bring back a swept lock file
+        except OSError:
+            return False  # no lock file, nobody is rendering
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        except BlockingIOError:
+            return True
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+        return False
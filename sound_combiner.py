@@ -1,38 +1,175 @@
+import json
+import os
+import numpy as np
 from pydub import AudioSegment
 
+def common_format(segments) -> tuple[int, int, int]:
+    """(frame_rate, channels, sample_width) that every segment can be brought to, same as pydub's overlay would."""
+    segments = list(segments)
+    frame_rate = max(s.frame_rate for s in segments)
+    channels = max(s.channels for s in segments)
+    sample_width = 4 if any(s.sample_width > 2 for s in segments) else 2
+    return frame_rate, channels, sample_width
+
+def segment_to_array(segment: AudioSegment, fmt: tuple[int, int, int]) -> np.ndarray:
+    frame_rate, channels, sample_width = fmt
+    segment = segment.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(sample_width)
+    return np.frombuffer(segment.raw_data, dtype=np.int32 if sample_width == 4 else np.int16)
+
+def array_to_segment(samples: np.ndarray, fmt: tuple[int, int, int]) -> AudioSegment:
+    """Clips a (possibly wider or float) sample array back into range and wraps it as an AudioSegment."""
+    frame_rate, channels, sample_width = fmt
+    limit = 2 ** (8 * sample_width - 1)
+    dtype = np.int32 if sample_width == 4 else np.int16
+    samples = np.clip(np.rint(samples), -limit, limit - 1).astype(dtype)
+    return AudioSegment(samples.tobytes(), frame_rate=frame_rate, sample_width=sample_width, channels=channels)
+
+def tile_segments(segments: list[AudioSegment | None], offsets_ms: list[float]) -> AudioSegment:
+    """
+    Overlap-adds segments at the given offsets (None entries are skipped).
+    Segments longer than the gap to the next offset are summed into it, so sample tails ringing across
+    the boundary are kept instead of being cut. Each distinct segment is converted to samples only once.
+    """
+    placed = [(seg, offset) for seg, offset in zip(segments, offsets_ms) if seg is not None]
+    if not placed:
+        return AudioSegment.silent(duration=0)
+    fmt = common_format(seg for seg, _ in placed)
+    frame_rate, channels, _ = fmt
+    arrays: dict[int, np.ndarray] = {}
+    starts = []
+    for seg, offset in placed:
+        if id(seg) not in arrays:
+            arrays[id(seg)] = segment_to_array(seg, fmt)
+        starts.append(round(offset * frame_rate / 1000) * channels)
+    mixed = np.zeros(max(start + len(arrays[id(seg)]) for (seg, _), start in zip(placed, starts)), dtype=np.int64)
+    for (seg, _), start in zip(placed, starts):
+        arr = arrays[id(seg)]
+        mixed[start:start + len(arr)] += arr
+    return array_to_segment(mixed, fmt)
+
+class StemMix:
+    """
+    Per-instrument stems aligned into the rows of one sample matrix.
+    Remixing is a single weighted sum over the rows, so changing levels or mutes
+    never needs the pattern or MuseScore to be rendered again.
+    """
+    CHUNK = 1 << 20  # samples per block in remix(), keeps the float buffer small for long songs
+    GAIN_RANGE_DB = (-60.0, 24.0)  # beyond it a stem is inaudible or clips throughout
+
+    def __init__(self, names: list[str], samples: np.ndarray, frame_rate: int, channels: int, sample_width: int):
+        if samples.shape[0] != len(names):
+            raise ValueError(f"Got {samples.shape[0]} stem rows for {len(names)} stem names.")
+        self.names = list(names)
+        self.samples = samples  # shape: (stems, frames * channels), interleaved like pydub raw data
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+
+    def __repr__(self):
+        return f"StemMix(stems={self.names}, duration={self.duration_ms}ms)"
+
+    @property
+    def duration_ms(self) -> int:
+        return int(self.samples.shape[1] / self.channels * 1000 / self.frame_rate) if self.frame_rate else 0
+
+    @classmethod
+    def from_segments(cls, segments: dict[str, AudioSegment]) -> "StemMix":
+        if not segments:
+            return cls([], np.zeros((0, 0), dtype=np.int16), 0, 1, 2)
+        fmt = common_format(segments.values())
+        arrays = [segment_to_array(seg, fmt) for seg in segments.values()]
+        samples = np.zeros((len(arrays), max(len(a) for a in arrays)), dtype=arrays[0].dtype)
+        for row, arr in zip(samples, arrays):
+            row[:len(arr)] = arr
+        return cls(list(segments), samples, *fmt)
+
+    def weights(self, gains: dict[str, float] | None = None, mutes=()) -> np.ndarray:
+        """Linear weight per stem from gains in dB (0.0 keeps the rendered level); muted stems get 0."""
+        gains = gains or {}
+        unknown = (set(gains) | set(mutes)) - set(self.names)
+        if unknown:
+            raise ValueError(f"Unknown stems: {', '.join(sorted(unknown))}. Available: {', '.join(self.names)}.")
+        low, high = self.GAIN_RANGE_DB
+        for name, gain in gains.items():
+            if not low <= gain <= high:  # also rejects nan
+                raise ValueError(f"Gain of {name} is {gain} dB, it must be between {low:g} and {high:g} dB.")
+        return np.array([0.0 if name in mutes else 10 ** (gains.get(name, 0.0) / 20) for name in self.names],
+                        dtype=np.float32)
+
+    def mix_samples(self, gains: dict[str, float] | None = None, mutes=(), start: int = 0, end: int | None = None) -> np.ndarray:
+        """Mixed samples of [start, end), clipped to the sample width."""
+        weights = self.weights(gains, mutes)
+        limit = 2 ** (8 * self.sample_width - 1)
+        end = self.samples.shape[1] if end is None else min(end, self.samples.shape[1])
+        mixed = np.empty(max(end - start, 0), dtype=self.samples.dtype)
+        for offset in range(0, len(mixed), self.CHUNK):
+            block = weights @ self.samples[:, start + offset:min(start + offset + self.CHUNK, end)].astype(np.float32)
+            mixed[offset:offset + self.CHUNK] = np.clip(np.rint(block), -limit, limit - 1)
+        return mixed
+
+    def remix(self, gains: dict[str, float] | None = None, mutes=()) -> AudioSegment:
+        mixed = self.mix_samples(gains, mutes)
+        if not self.frame_rate:
+            return AudioSegment.silent(duration=0)
+        return AudioSegment(mixed.tobytes(), frame_rate=self.frame_rate,
+                            sample_width=self.sample_width, channels=self.channels)
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, "stems.npy"), self.samples)
+        with open(os.path.join(directory, "stems.json"), "w") as f:
+            json.dump({"names": self.names, "frame_rate": self.frame_rate,
+                       "channels": self.channels, "sample_width": self.sample_width}, f)
+
+    @classmethod
+    def load(cls, directory: str) -> "StemMix":
+        with open(os.path.join(directory, "stems.json")) as f:
+            meta = json.load(f)
+        # memory-mapped: a remix only touches the pages it sums
+        samples = np.load(os.path.join(directory, "stems.npy"), mmap_mode="r")
+        return cls(meta["names"], samples, meta["frame_rate"], meta["channels"], meta["sample_width"])
+
 class AudioCombiner:
     def __init__(self, tempo: int=120, ts: int=4):
         self.cache = {}
-        self.main_audio = AudioSegment.silent(duration=0)
+        self.stems: dict[str, AudioSegment] = {}  # one track per instrument, mixed on demand
         self.set_tempo(tempo)
         self.ts=ts
-    
+
     def set_tempo(self, tempo: int):
         self.tempo = tempo
         self.quarter_duration = 60000 / tempo  # in millis
-    
-    def place_at(self, file_path: str, measure: int, quarter: float, multiplet_num: int =0, multiplet_din: int=3, volume_step: float = 0.0):
+
+    def place_at(self, file_path: str, measure: int, quarter: float, multiplet_num: int =0, multiplet_din: int=3, volume_step: float = 0.0, stem: str = "main"):
         # Calculate start time in milliseconds
         start_time = int((measure * self.ts + quarter) * self.quarter_duration)
         if multiplet_num >0:
             start_time += int(self.quarter_duration * multiplet_num / multiplet_din)
-        
+
         # Load audio file (use cache if available)
         if file_path not in self.cache:
             self.cache[file_path] = AudioSegment.from_file(file_path) + volume_step
-        
+
         sound = self.cache[file_path]
-        
+        track = self.stems.get(stem, AudioSegment.silent(duration=0))
+
         # add silence if needed:
         overlayed_sound_end_pos = start_time + len(sound)
-        if len(self.main_audio) < overlayed_sound_end_pos:
-            silence_duration = overlayed_sound_end_pos - len(self.main_audio)
-            self.main_audio += AudioSegment.silent(duration=silence_duration)
+        if len(track) < overlayed_sound_end_pos:
+            silence_duration = overlayed_sound_end_pos - len(track)
+            track += AudioSegment.silent(duration=silence_duration)
         # Overlay the sound at calculated position
-        self.main_audio = self.main_audio.overlay(
+        self.stems[stem] = track.overlay(
             sound,
             position=start_time
         )
-    
+
+    def stem_mix(self) -> StemMix:
+        return StemMix.from_segments(self.stems)
+
+    @property
+    def main_audio(self) -> AudioSegment:
+        return self.stem_mix().remix()
+
     def export(self, output_file: str, format: str ="wav"):
-        self.main_audio.export(output_file, format=format)
\ No newline at end of file
+        self.main_audio.export(output_file, format=format)
@@ -0,0 +1,141 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from admission import AdmissionError, Limits, RenderBudget, check_chart, count_quarters, estimate_cost
+from bass import ChordProgression
+
+CHARTS = [
+    "C\nF\nG7 C",
+    "*a\nDm7 G7\nCmaj7\n*b\nF7\n**a\n**b\n**a",
+    "@title Song\n#intro\n*a\nC\n*a\nG\n**a\n**missing",
+    "*a\nC\n**a\n*b\nD\n**a\n**b",
+    "#*a\nC F\n#**a",
+]
+
+@pytest.mark.parametrize("chart", CHARTS)
+def test_count_matches_expanded_progression(chart):
+    expanded = list(ChordProgression.from_string(chart))
+    assert count_quarters(chart) == sum(item.duration for item in expanded if item.is_chord)
+
+def test_section_references_multiply_cost():
+    chart = "*verse\n" + "C\n" * 100 + "\n".join(["**verse"] * 50)
+    cost = estimate_cost(chart, tempo=120)
+    assert cost.bars == 100 * 51
+    assert cost.duration_s == pytest.approx(5100 * 2 + 1)
+
+@pytest.mark.parametrize("limits, chart", [
+    (Limits(max_chart_chars=5), "C\nF\nG\nC\n"),
+    (Limits(max_bars=3), "C\nF\nG\nC"),
+    (Limits(max_duration_s=5), "C\nF\nG\nC"),
+    (Limits(max_output_bytes=1000), "C"),
+])
+def test_limits_reject_with_413(limits, chart):
+    with pytest.raises(AdmissionError) as e:
+        check_chart(chart, limits)
+    assert e.value.status_code == 413
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def test_budget_queues_until_capacity_frees(tmp_path):
+    async def scenario():
+        budget = RenderBudget(Limits(budget_bars=10, queue_timeout_s=5), str(tmp_path / "budget.sqlite"))
+        order = []
+        async def job(name, cost, client, hold, arrive=0.01):
+            await asyncio.sleep(arrive)
+            async with budget.reserve(cost, client):
+                order.append(name)
+                await asyncio.sleep(hold)
+        await asyncio.gather(job("big", 8, "a", 0.2, arrive=0), job("second", 8, "b", 0),
+                             job("small", 2, "c", 0, arrive=0.05))
+        return order, budget.in_use, budget.per_client
+    order, in_use, per_client = run(scenario())
+    # small would fit next to big, but second has been waiting longer
+    assert order == ["big", "second", "small"]
+    assert in_use == 0 and per_client == {}
+
+def test_full_queue_gets_429(tmp_path):
+    async def scenario():
+        budget = RenderBudget(Limits(budget_bars=1, max_queued=1, queue_timeout_s=5), str(tmp_path / "budget.sqlite"))
+        async def hold():
+            async with budget.reserve(1, "a"):
+                await asyncio.sleep(0.1)
+        tasks = [asyncio.create_task(hold()) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        with pytest.raises(AdmissionError) as e:
+            async with budget.reserve(1, "b"):
+                pass
+        await asyncio.gather(*tasks)
+        return e.value
+    error = run(scenario())
+    assert error.status_code == 429 and error.retry_after == 5
+
+def test_queue_timeout_gets_503(tmp_path):
+    async def scenario():
+        budget = RenderBudget(Limits(budget_bars=1, queue_timeout_s=0.05), str(tmp_path / "budget.sqlite"))
+        async def hold():
+            async with budget.reserve(1, "a"):
+                await asyncio.sleep(0.2)
+        task = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+        with pytest.raises(AdmissionError) as e:
+            async with budget.reserve(1, "b"):
+                pass
+        await task
+        return e.value, budget
+    error, budget = run(scenario())
+    assert error.status_code == 503
+    assert budget.queued == 0 and budget.per_client == {}
+
+def test_one_client_cannot_take_every_slot(tmp_path):
+    async def scenario():
+        budget = RenderBudget(Limits(budget_bars=100, max_per_client=2), str(tmp_path / "budget.sqlite"))
+        async with budget.reserve(1, "greedy"), budget.reserve(1, "greedy"):
+            with pytest.raises(AdmissionError) as e:
+                async with budget.reserve(1, "greedy"):
+                    pass
+            async with budget.reserve(1, "other"):
+                pass
+        return e.value
+    assert run(scenario()).status_code == 429
+
+def test_per_client_limit_is_off_by_default(tmp_path):
+    async def scenario():
+        budget = RenderBudget(Limits(budget_bars=100), str(tmp_path / "budget.sqlite"))
+        async with budget.reserve(1, "proxy"), budget.reserve(1, "proxy"), budget.reserve(1, "proxy"):
+            return budget.per_client
+    assert run(scenario()) == {"proxy": 3}
+
+def test_budget_is_shared_by_every_process_using_the_file(tmp_path):
+    async def scenario():
+        limits = Limits(budget_bars=10, queue_timeout_s=0.1)
+        worker_a, worker_b = (RenderBudget(limits, str(tmp_path / "budget.sqlite")) for _ in range(2))
+        async with worker_a.reserve(8, "a"):
+            assert worker_b.in_use == 8
+            with pytest.raises(AdmissionError) as e:
+                async with worker_b.reserve(8, "b"):
+                    pass
+        async with worker_b.reserve(8, "b"):
+            pass
+        return e.value, worker_a.queued
+    error, queued = run(scenario())
+    assert error.status_code == 503 and queued == 0
+
+def test_stale_reservations_are_dropped_and_held_ones_kept_alive(tmp_path):
+    path = str(tmp_path / "budget.sqlite")
+    budget = RenderBudget(Limits(budget_bars=10, queue_timeout_s=0.1), path)
+    budget.HEARTBEAT_S, budget.STALE_S = 0.02, 0.1
+    with sqlite3.connect(path) as db:  # left by a process that died, here or on another host
+        db.execute("INSERT INTO reservations (client, cost, running, heartbeat_at) VALUES ('x', 10, 1, ?)",
+                   (time.time() - 1,))
+    async def scenario():
+        async with budget.reserve(10, "a"):
+            await asyncio.sleep(0.3)  # longer than STALE_S, the heartbeat keeps the reservation
+            assert budget.per_client == {"a": 1}
+            with pytest.raises(AdmissionError):
+                async with budget.reserve(1, "b"):
+                    pass
+    run(scenario())
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+import bass_batch
+from bass import ChordProgression
+from harmony import LOWER_BOUND, UPPER_BOUND
+
+CHART = "Dm7 G7\nCmaj7\nF7 Bb7\nC G\nA7 Dm7"
+
+@pytest.fixture
+def spans():
+    return bass_batch.spans_from_items(list(ChordProgression.from_string(CHART)))
+
+def test_spans_lead_back_to_first_chord(spans):
+    assert [span.quarters for span in spans] == [2, 2, 4, 2, 2, 2, 2, 2, 2]
+    assert str(spans[0].next_chord) == "G7"
+    assert str(spans[-1].next_chord) == "Dm7"
+
+def test_walks_shape_and_bounds(spans):
+    walks, approach_columns = bass_batch.generate_walks(spans, 32, rng=np.random.default_rng(1))
+    assert walks.shape == (32, 20 + 1)
+    assert len(approach_columns) == len(spans)
+    assert ((walks >= LOWER_BOUND) & (walks <= UPPER_BOUND)).all()
+    assert (walks[:, 0] == 38).all()  # D2
+    assert (walks[:, -1] % 12 == 2).all()  # back on D
+
+def test_every_chord_starts_on_its_root(spans):
+    walks, _ = bass_batch.generate_walks(spans, 16, rng=np.random.default_rng(2))
+    column = 0
+    for span in spans:
+        assert (walks[:, column] % 12 == span.chord.root.num_value() % 12).all()
+        column += span.note_count
+
+def test_start_and_end_are_fixed(spans):
+    walks, _ = bass_batch.generate_walks(spans[:3], 8, start=50, end=43, rng=np.random.default_rng(3))
+    assert (walks[:, 0] == 50).all()
+    assert (walks[:, -1] == 43).all()
+
+def test_score_prefers_chromatic_approach_and_no_repeats():
+    approach_columns = np.array([2])
+    chromatic = [36, 38, 41, 40]  # F -> E
+    leap = [36, 38, 47, 40]
+    repeated = [36, 36, 41, 40]
+    scores = bass_batch.score_walks(np.array([chromatic, leap, repeated]), approach_columns)
+    assert scores[0] > scores[1]
+    assert scores[0] > scores[2]
+
+def test_best_bass_line_matches_legacy_length():
+    prog = ChordProgression.from_string(CHART)
+    best = prog.generate_best_bass_line(64)
+    assert len(best) == sum(item.duration for item in prog if item.is_chord) + 1
+    assert all(note.length == 2 for note in best)
@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+
+from broker import CANCELLED, DONE, FAILED, QUEUED, RUNNING, FileArtifactStore, SQLiteBroker
+from worker import WAV_ARTIFACT, process_job, purge_jobs, run_worker
+
+def test_submit_claim_complete(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.sqlite"))
+    job_id = broker.submit({"chord_progression": "C7", "session_id": "s"})
+    assert broker.get(job_id).status == QUEUED
+    job = broker.claim("w1")
+    assert (job.id, job.payload["session_id"], job.status, job.attempts) == (job_id, "s", RUNNING, 1)
+    assert broker.claim("w2") is None
+    broker.complete(job_id, {"wav": "out.wav"}, "w1")
+    done = broker.get(job_id)
+    assert (done.status, done.result, done.worker_id, done.finished) == (DONE, {"wav": "out.wav"}, "w1", True)
+    assert broker.get("missing") is None
+
+def test_jobs_are_claimed_oldest_first_and_failures_recorded(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.sqlite"))
+    first, second = broker.submit({"n": 1}), broker.submit({"n": 2})
+    assert broker.claim("w").id == first
+    broker.fail(first, "boom", "w")
+    assert (broker.get(first).status, broker.get(first).error) == (FAILED, "boom")
+    assert broker.claim("w").id == second
+
+def test_concurrent_claimers_never_share_a_job(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    broker = SQLiteBroker(path)
+    job_ids = {broker.submit({"n": n}) for n in range(30)}
+    claimed = []
+    def claimer(name):
+        own = SQLiteBroker(path)
+        while (job := own.claim(name)) is not None:
+            claimed.append(job.id)
+    threads = [threading.Thread(target=claimer, args=(f"w{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed) == sorted(job_ids)
+
+def test_expired_lease_is_reclaimed_until_attempts_run_out(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.sqlite"), lease_s=0.01, max_attempts=2)
+    job_id = broker.submit({})
+    assert broker.claim("dead-worker").id == job_id
+    time.sleep(0.02)
+    retried = broker.claim("w2")
+    assert (retried.id, retried.attempts) == (job_id, 2)
+    time.sleep(0.02)
+    assert broker.claim("w3") is None
+    assert broker.get(job_id).status == FAILED
+
+def test_artifact_store_put_and_delete(tmp_path):
+    store = FileArtifactStore(str(tmp_path / "artifacts"))
+    source = tmp_path / "out.wav"
+    source.write_bytes(b"RIFF")
+    job_id = "6f1c1c9e-8a1e-4a43-9d44-5f2ab1c0e111"
+    store.put(job_id, "final.wav", str(source))
+    with open(store.path(job_id, "final.wav"), "rb") as f:
+        assert f.read() == b"RIFF"
+    assert os.listdir(os.path.dirname(store.path(job_id, "final.wav"))) == ["final.wav"]
+    store.delete(job_id)
+    assert not os.path.exists(store.path(job_id, "final.wav"))
+
+def test_worker_renders_jobs_into_the_store(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.sqlite"))
+    store = FileArtifactStore(str(tmp_path / "artifacts"))
+    def fake_render(chord_progression, session_id, work_dir, base_session_id=None):
+        if chord_progression == "bad":
+            raise ValueError("unparsable chart")
+        wav_path = os.path.join(work_dir, "final_composition.wav")
+        with open(wav_path, "w") as f:
+            f.write(f"{session_id}:{chord_progression}")
+        return wav_path
+    ok = broker.submit({"chord_progression": "C7", "session_id": "a"})
+    bad = broker.submit({"chord_progression": "bad", "session_id": "b"})
+    assert run_worker(broker, store, "w", poll_interval_s=0.01, max_jobs=2, render=fake_render) == 2
+
+    job = broker.get(ok)
+    assert job.status == DONE and job.result == {"session_id": "a", "wav": WAV_ARTIFACT}
+    with open(store.path(ok, WAV_ARTIFACT)) as f:
+        assert f.read() == "a:C7"
+    assert broker.get(bad).status == FAILED
+    assert "unparsable chart" in broker.get(bad).error
+
+def test_cancelled_jobs_are_skipped_and_their_results_discarded(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.sqlite"))
+    queued, running = broker.submit({"n": 1}), broker.submit({"n": 2})
+    broker.cancel(queued)
+    assert broker.claim("w").id == running
+    assert broker.claim("w") is None
+    broker.cancel(running)
+    assert not broker.complete(running, {"wav": "out.wav"}, "w")
+    assert broker.get(running).status == CANCELLED and broker.get(running).finished
+    finished = broker.submit({"n": 3})
+    broker.claim("w")
+    assert broker.complete(finished, {}, "w")
+    broker.cancel(finished)
+    assert broker.get(finished).status == DONE
+
+def test_worker_drops_the_artifact_of_a_job_cancelled_while_rendering(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.sqlite"))
+    store = FileArtifactStore(str(tmp_path / "artifacts"))
+    job_id = broker.submit({"chord_progression": "C7", "session_id": "a"})
+    def render_then_cancel(chord_progression, session_id, work_dir, base_session_id=None):
+        broker.cancel(job_id)  # the app timed out meanwhile
+        wav_path = os.path.join(work_dir, "final_composition.wav")
+        with open(wav_path, "w") as f:
+            f.write("audio")
+        return wav_path
+    run_worker(broker, store, "w", poll_interval_s=0.01, max_jobs=1, render=render_then_cancel)
+    assert broker.get(job_id).status == CANCELLED
+    assert not os.path.exists(store.path(job_id, WAV_ARTIFACT))
+
+def test_purge_deletes_old_finished_jobs_and_their_artifacts(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.sqlite"))
+    store = FileArtifactStore(str(tmp_path / "artifacts"))
+    source = tmp_path / "out.wav"
+    source.write_bytes(b"RIFF")
+    done, cancelled, queued = (broker.submit({"n": n}) for n in range(3))
+    broker.claim("w")
+    broker.complete(done, {"wav": WAV_ARTIFACT}, "w")
+    store.put(done, WAV_ARTIFACT, str(source))  # never collected by the app
+    broker.cancel(cancelled)
+    assert purge_jobs(broker, store, older_than_s=60) == 0
+    time.sleep(0.02)
+    assert purge_jobs(broker, store, older_than_s=0.01) == 2
+    assert broker.get(done) is None and broker.get(cancelled) is None
+    assert broker.get(queued).status == QUEUED
+    assert not os.path.exists(store.path(done, WAV_ARTIFACT))
+
+def test_worker_purges_while_waiting_for_jobs(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.sqlite"))
+    store = FileArtifactStore(str(tmp_path / "artifacts"))
+    old = broker.submit({})
+    broker.cancel(old)
+    time.sleep(0.02)
+    broker.submit({"chord_progression": "C7", "session_id": "a"})
+    def fake_render(chord_progression, session_id, work_dir, base_session_id=None):
+        wav_path = os.path.join(work_dir, "final_composition.wav")
+        open(wav_path, "w").close()
+        return wav_path
+    run_worker(broker, store, "w", poll_interval_s=0.01, max_jobs=1, render=fake_render, job_retention_s=0.01)
+    assert broker.get(old) is None
+
+def test_only_the_current_claim_can_finish_a_job(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.sqlite"), lease_s=0.01)
+    job_id = broker.submit({})
+    broker.claim("stale")
+    time.sleep(0.02)
+    broker.claim("current")
+    assert not broker.renew(job_id, "stale") and broker.renew(job_id, "current")
+    assert not broker.fail(job_id, "late failure", "stale")
+    assert broker.complete(job_id, {"wav": "out.wav"}, "current")
+    assert not broker.complete(job_id, {}, "stale")
+    assert (broker.get(job_id).status, broker.get(job_id).worker_id) == (DONE, "current")
+
+def test_worker_whose_job_was_taken_over_keeps_the_artifact(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.sqlite"), lease_s=0.01)
+    store = FileArtifactStore(str(tmp_path / "artifacts"))
+    job_id = broker.submit({"chord_progression": "C7", "session_id": "a"})
+    stale = broker.claim("stale")
+    def render(chord_progression, session_id, work_dir, base_session_id=None):
+        wav_path = os.path.join(work_dir, "final_composition.wav")
+        with open(wav_path, "w") as f:
+            f.write("audio")
+        return wav_path
+    time.sleep(0.02)
+    process_job(broker, store, broker.claim("current"), render)
+    process_job(broker, store, stale, render)
+    assert broker.get(job_id).status == DONE
+    assert os.path.exists(store.path(job_id, WAV_ARTIFACT))
+
+def test_lease_is_renewed_while_rendering(tmp_path):
+    broker = SQLiteBroker(str(tmp_path / "jobs.sqlite"), lease_s=0.06)
+    store = FileArtifactStore(str(tmp_path / "artifacts"))
+    job_id = broker.submit({"chord_progression": "C7", "session_id": "a"})
+    def slow_render(chord_progression, session_id, work_dir, base_session_id=None):
+        time.sleep(0.3)  # several leases long
+        assert broker.claim("other") is None
+        wav_path = os.path.join(work_dir, "final_composition.wav")
+        open(wav_path, "w").close()
+        return wav_path
+    process_job(broker, store, broker.claim("w"), slow_render)
+    assert (broker.get(job_id).status, broker.get(job_id).attempts) == (DONE, 1)
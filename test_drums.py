@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+import drums
+from drums import DrumPattern, STEMS
+from sound_combiner import common_format, segment_to_array
+
+pytestmark = pytest.mark.usefixtures("drum_samples")
+
+def test_variant_pool_is_cached_per_tempo():
+    pattern = DrumPattern(tempo=120)
+    pool = pattern.bar_variants(3)
+    assert len(pool) == 3
+    assert DrumPattern(tempo=120).bar_variants(2) == pool[:2]
+    assert DrumPattern(tempo=150).bar_variants(1)[0] is not pool[0]
+
+def test_create_pattern_tiles_variants():
+    pattern = DrumPattern(tempo=120)
+    pattern.create_pattern(bars=8, variants=4)
+    assert len(pattern.layout) == 8
+    assert set(pattern.layout) <= set(range(4))
+    assert set(pattern.combiner.stems) <= set(STEMS)
+    assert len(pattern.combiner.stems["kick"]) >= 7 * 2000  # last kick starts at bar 8
+
+def test_tails_ring_into_next_bar():
+    pattern = DrumPattern(tempo=120)
+    pool = pattern.bar_variants(2)
+    pattern.tile([0, 1], pool)
+    ride = pattern.combiner.stems["ride"]
+    fmt = common_format([ride])
+    first, second = (segment_to_array(pool[i]["ride"], fmt) for i in (0, 1))
+    assert len(first) > fmt[0] * 2  # the first bar's tail is longer than the bar itself
+    expected = np.zeros(len(segment_to_array(ride, fmt)), dtype=np.int64)
+    expected[:len(first)] += first
+    bar = fmt[0] * 2 * fmt[1]
+    expected[bar:bar + len(second)] += second
+    assert np.array_equal(segment_to_array(ride, fmt), np.clip(expected, -32768, 32767))
+
+def test_hit_by_hit_rendering_still_available():
+    pattern = DrumPattern(tempo=120)
+    pattern.create_pattern(bars=2, variants=0)
+    assert pattern.layout is None
+    assert {"kick", "ride", "hihat"} <= set(pattern.combiner.stems)
+    assert drums._bar_variant_pools == {}
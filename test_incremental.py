@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+from pydub import AudioSegment
+
+import bass_batch
+import incremental
+from bass import ChordProgression
+from drums import DrumPattern
+from incremental import SessionState, load_state, plan_edit, rerender, save_state
+
+FRAME_RATE = 22050
+BAR = FRAME_RATE * 2  # samples per bar at 120 bpm, mono
+FADE = round(incremental.FADE_MS * FRAME_RATE / 1000)
+CHART = "Cmaj7\nA7\nDm7 G7\nCmaj7\nFmaj7\nBb7\nEm7 A7\nDm7 G7"
+
+pytestmark = pytest.mark.usefixtures("drum_samples")
+
+def fake_bass(midi_numbers, calls=None):
+    """One quarter note per number at a level encoding the pitch, with a ringing tail after the last one."""
+    if calls is not None:
+        calls.append(list(midi_numbers))
+    quarter = FRAME_RATE // 2
+    samples = np.concatenate([np.repeat(np.int16(midi * 100), quarter) for midi in midi_numbers] +
+                             [np.full(quarter // 2, midi_numbers[-1] * 50, dtype=np.int16)])
+    return AudioSegment(samples.tobytes(), frame_rate=FRAME_RATE, sample_width=2, channels=1)
+
+def full_render(chart):
+    items = list(ChordProgression.from_string(chart))
+    walk = bass_batch.best_walk(bass_batch.spans_from_items(items), 16, rng=np.random.default_rng(0))
+    pattern = DrumPattern(tempo=120)
+    pattern.create_pattern(bars=len(chart.splitlines()))
+    pattern.combiner.stems["bass"] = fake_bass(walk.tolist())
+    stems = pattern.combiner.stem_mix()
+    return SessionState.from_render(items, walk, pattern.layout, 120, 4), stems, stems.mix_samples()
+
+def edit(session, chart, calls):
+    state, stems, mixed = session
+    items = list(ChordProgression.from_string(chart))
+    return rerender(state, stems, mixed, items, lambda notes: fake_bass(notes, calls), 16, np.random.default_rng(1))
+
+def test_plan_edit():
+    a, b, c, d, x = (("A", 4),), (("B", 4),), (("C", 4),), (("D", 4),), (("X", 4),)
+    assert plan_edit([a, b, c, d], [a, b, c, d]) == ([0, 1, 2, 3], [0, 1, 2, 3])
+    # the bar before a change gets a new approach note, drums of replaced bars are kept
+    assert plan_edit([a, b, c, d], [a, x, c, d]) == ([None, None, 2, 3], [0, 1, 2, 3])
+    assert plan_edit([a, b, c, d], [a, b, x, c, d]) == ([0, None, None, 2, 3], [0, 1, None, 2, 3])
+    assert plan_edit([a, b, c, d], [a, b, d]) == ([0, None, 3], [0, 1, 3])
+    # the last bar leads back into the first one
+    assert plan_edit([a, b, c, d], [x, b, c, d]) == ([None, 1, 2, None], [0, 1, 2, 3])
+
+def test_plan_edit_keeps_repeats_aligned():
+    chorus = [(("A", 4),), (("B", 4),), (("C", 4),), (("D", 4),)]
+    old = chorus * 4
+    new = list(old)
+    new[9] = (("X", 4),)
+    bass_map, drum_map = plan_edit(old, new)
+    assert drum_map == list(range(16))
+    assert [j for j, i in enumerate(bass_map) if i is None] == [8, 9]
+
+def test_unchanged_chart_renders_nothing():
+    session = full_render(CHART)
+    calls = []
+    result = edit(session, CHART, calls)
+    assert calls == [] and (result.bass_bars, result.drum_bars) == (0, 0)
+    assert np.array_equal(result.mixed, session[2])
+    assert result.state == session[0]
+
+def test_edit_renders_only_the_changed_bar_and_the_one_before():
+    session = full_render(CHART)
+    old_state, _, old_mixed = session
+    lines = CHART.splitlines()
+    lines[5] = "Eb7"
+    calls = []
+    result = edit(session, "\n".join(lines), calls)
+
+    assert [len(notes) for notes in calls] == [8]  # bars 5 and 6
+    assert (result.bass_bars, result.drum_bars) == (2, 0)
+    walk = np.array(result.state.walk)
+    old_walk = np.array(old_state.walk)
+    assert np.array_equal(walk[:17], old_walk[:17])  # up to the first note of bar 5
+    assert np.array_equal(walk[24:], old_walk[24:])  # from the first note of bar 7
+    assert result.state.layout == old_state.layout
+    assert np.array_equal(result.mixed[:4 * BAR], old_mixed[:4 * BAR])
+    assert np.array_equal(result.mixed[6 * BAR + FADE:], old_mixed[6 * BAR + FADE:])
+    assert not np.array_equal(result.mixed[4 * BAR:6 * BAR], old_mixed[4 * BAR:6 * BAR])
+    assert np.array_equal(result.mixed, result.stems.mix_samples())
+
+def test_inserted_bar_shifts_the_rest():
+    session = full_render(CHART)
+    old_state, _, old_mixed = session
+    lines = CHART.splitlines()
+    calls = []
+    result = edit(session, "\n".join(lines[:3] + ["E7"] + lines[3:]), calls)
+
+    assert [len(notes) for notes in calls] == [8]  # bar 3 and the inserted bar
+    assert (result.bass_bars, result.drum_bars) == (2, 1)
+    assert result.state.layout[:3] == old_state.layout[:3] and result.state.layout[4:] == old_state.layout[3:]
+    assert np.array_equal(result.mixed[:2 * BAR], old_mixed[:2 * BAR])
+    assert np.array_equal(result.mixed[4 * BAR + FADE:], old_mixed[3 * BAR + FADE:])
+    assert len(result.mixed) == len(old_mixed) + BAR
+    assert np.array_equal(result.mixed, result.stems.mix_samples())
+
+def test_new_first_chord_renews_the_ending():
+    session = full_render(CHART)
+    lines = CHART.splitlines()
+    calls = []
+    result = edit(session, "\n".join(["C6"] + lines[1:]), calls)
+    # bar 1 and the last bar with the resolution note, which leads back into the first chord
+    assert sorted(len(notes) for notes in calls) == [4, 5]
+    assert np.array_equal(result.mixed, result.stems.mix_samples())
+
+def test_state_round_trip(tmp_path):
+    state, stems, mixed = full_render(CHART)
+    stems.save(str(tmp_path / "session"))
+    save_state(str(tmp_path / "session"), state, mixed)
+    loaded_state, loaded_stems, loaded_mixed = load_state(str(tmp_path / "session"))
+    assert loaded_state == state
+    assert loaded_stems.names == stems.names
+    assert np.array_equal(loaded_mixed, mixed)
+    assert load_state(str(tmp_path / "missing")) is None
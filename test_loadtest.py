@@ -0,0 +1,40 @@
+import wave
+
+import pytest
+from music21 import stream, note as m21_note
+
+import fake_musescore
+from loadtest import drum_sample_names, make_chart, percentile, summarize
+
+@pytest.mark.parametrize("pct, expected", [(50, 5), (95, 10), (99, 10), (10, 1)])
+def test_percentile_nearest_rank(pct, expected):
+    assert percentile(list(range(10, 0, -1)), pct) == expected
+
+def test_make_chart_has_one_line_per_bar():
+    assert len(make_chart(37).splitlines()) == 37
+
+def test_drum_sample_names_cover_ranges():
+    names = drum_sample_names()
+    assert "1.wav" in names and "2.wav" in names  # big_drum
+    assert "9_1_7.wav" in names  # clap
+    assert "211.wav" in names and "215.wav" in names  # ride1
+
+def test_summarize_counts_errors():
+    results = [{"bars": 4, "status": 200, "error": None, "bytes": 1, "latency": 1.0},
+               {"bars": 4, "status": 500, "error": "boom", "bytes": 0, "latency": 0.1}]
+    summary = summarize(results, elapsed=2.0)
+    assert summary["error_rate"] == 0.5
+    assert summary["throughput_rps"] == 0.5
+    assert summary["first_error"]["status"] == 500
+
+def test_fake_musescore_writes_right_length(tmp_path, monkeypatch):
+    bass = stream.Stream()
+    for i in range(12):
+        bass.append(m21_note.Note(40 + i % 3))
+    xml_path, wav_path = str(tmp_path / "bass.xml"), str(tmp_path / "bass.wav")
+    bass.write("musicxml", fp=xml_path)
+    monkeypatch.setenv("FAKE_MUSESCORE_DELAY", "0")
+    monkeypatch.setenv("FAKE_MUSESCORE_TAIL", "0")
+    assert fake_musescore.main(["fake_musescore.py", xml_path, "-o", wav_path]) == 0
+    with wave.open(wav_path) as wav:
+        assert wav.getnframes() == 6 * wav.getframerate()  # 12 quarters at 120 bpm
@@ -0,0 +1,25 @@
+import os
+import time
+
+from pipeline import prune_stem_sessions
+
+def make_session(stems_dir, name, size, age_s):
+    session = stems_dir / name
+    session.mkdir()
+    (session / "stems.npy").write_bytes(b"\0" * size)
+    mtime = time.time() - age_s
+    os.utime(session, (mtime, mtime))
+
+def test_prune_bounds_stem_cache_by_bytes_and_age(tmp_path):
+    make_session(tmp_path, "newest", 600, 0)
+    make_session(tmp_path, "recent", 300, 10)
+    make_session(tmp_path, "over_budget", 300, 20)
+    make_session(tmp_path, "expired", 1, 7200)
+    prune_stem_sessions(str(tmp_path), max_bytes=1000, max_age_s=3600)
+    assert sorted(os.listdir(tmp_path)) == ["newest", "recent"]
+
+def test_prune_keeps_the_newest_session_even_if_too_big(tmp_path):
+    make_session(tmp_path, "huge", 5000, 0)
+    make_session(tmp_path, "older", 10, 5)
+    prune_stem_sessions(str(tmp_path), max_bytes=1000, max_age_s=3600)
+    assert os.listdir(tmp_path) == ["huge"]
@@ -0,0 +1,78 @@
+import os
+import threading
+import time
+
+from profiling import RequestProfiler, prune_reports
+
+def busy_wait(seconds):
+    deadline = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < deadline:
+        total += 1
+    return total
+
+def allocate():
+    return [bytearray(1024) for _ in range(2000)]
+
+def test_samples_show_profiled_function():
+    with RequestProfiler(interval=0.001) as profiler:
+        busy_wait(0.1)
+    assert profiler.wall_time >= 0.1
+    assert sum(profiler.stacks.values()) > 10
+    assert any("busy_wait (test_profiling.py" in stack for stack in profiler.stacks)
+
+def test_collapsed_format():
+    with RequestProfiler(interval=0.001, trace_allocations=False) as profiler:
+        busy_wait(0.05)
+    for line in profiler.collapsed().splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert ";" in stack
+        assert int(count) > 0
+
+def test_summary_lists_allocations(tmp_path):
+    with RequestProfiler(interval=0.001) as profiler:
+        kept = allocate()
+    assert len(kept) == 2000
+    assert profiler.peak_memory >= 2000 * 1024
+    summary = profiler.summary()
+    assert "own %" in summary
+    assert "test_profiling.py" in summary
+    collapsed_path, summary_path = profiler.save(str(tmp_path), "report")
+    assert open(summary_path).read() == summary
+    assert open(collapsed_path).read() == profiler.collapsed()
+
+def test_concurrent_profilers_take_turns_with_tracemalloc():
+    results = {}
+    first_inside, second_inside, first_done = threading.Event(), threading.Event(), threading.Event()
+    def first():
+        with RequestProfiler(interval=0.001) as profiler:
+            kept = allocate()
+            first_inside.set()
+            second_inside.wait(0.5)  # without turns the second profiler would start in here
+        first_done.set()
+        results["first"] = (profiler, kept)
+    def second():
+        first_inside.wait()
+        with RequestProfiler(interval=0.001) as profiler:
+            second_inside.set()
+            kept = allocate()
+            first_done.wait(5)  # and the first one would stop tracemalloc in here
+        results["second"] = (profiler, kept)
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for profiler, _ in results.values():
+        assert profiler.peak_memory >= 2000 * 1024
+        assert profiler.allocations
+
+def test_prune_reports_by_count_and_age(tmp_path):
+    now = time.time()
+    for age, name in enumerate(["a", "b", "c", "d"]):
+        for extension in ("txt", "collapsed"):
+            path = tmp_path / f"{name}.{extension}"
+            path.write_text("")
+            os.utime(path, (now - age * 100, now - age * 100))
+    prune_reports(str(tmp_path), max_count=3, max_age_s=150)
+    assert sorted(os.listdir(tmp_path)) == ["a.collapsed", "a.txt", "b.collapsed", "b.txt"]
@@ -0,0 +1,134 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+from singleflight import SingleFlight, normalize_chart, request_key
+
+def test_key_ignores_formatting_but_not_content_or_params():
+    chart = "@title Blues\nF7   Bb7\n\n  C7\n"
+    assert request_key(chart, tempo=120) == request_key("F7 Bb7\nC7", tempo=120)
+    assert request_key(chart, tempo=120) != request_key("F7 Bb7\nC7\nC7", tempo=120)
+    assert request_key(chart, tempo=120) != request_key(chart, tempo=140)
+    assert normalize_chart(chart) == "F7 Bb7\nC7"
+
+def make_render(calls, delay=0.05, fail=False):
+    async def render(result_dir):
+        calls.append(result_dir)
+        await asyncio.sleep(delay)
+        if fail:
+            raise RuntimeError("render failed")
+        with open(os.path.join(result_dir, "out.wav"), "w") as f:
+            f.write("audio")
+        return {"wav": "out.wav", "render": len(calls)}
+    return render
+
+def test_concurrent_identical_requests_render_once(tmp_path):
+    calls = []
+    flight = SingleFlight(str(tmp_path))
+    async def scenario():
+        return await asyncio.gather(*(flight.run("k", make_render(calls)) for _ in range(5)))
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert {r.result_dir for r in results} == {calls[0]}
+    assert sorted(r.shared for r in results) == [False, True, True, True, True]
+    assert all(r.meta == {"wav": "out.wav", "render": 1} for r in results)
+
+def test_workers_share_through_lock_and_marker(tmp_path):
+    # two instances stand for two worker processes: they share only the directory
+    calls = []
+    first, second = SingleFlight(str(tmp_path), poll_interval_s=0.01), SingleFlight(str(tmp_path), poll_interval_s=0.01)
+    async def scenario():
+        return await asyncio.gather(first.run("k", make_render(calls)), second.run("k", make_render(calls)))
+    a, b = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert a.result_dir == b.result_dir
+    assert {a.shared, b.shared} == {False, True}
+
+def test_failure_reaches_waiters_and_is_not_cached(tmp_path):
+    calls = []
+    flight = SingleFlight(str(tmp_path))
+    async def scenario():
+        return await asyncio.gather(*(flight.run("k", make_render(calls, fail=True)) for _ in range(3)),
+                                    return_exceptions=True)
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert not asyncio.run(flight.run("k", make_render(calls))).shared
+    assert len(calls) == 2
+
+def test_finished_results_are_not_served_to_later_requests(tmp_path):
+    calls = []
+    flight = SingleFlight(str(tmp_path))
+    first = asyncio.run(flight.run("k", make_render(calls, delay=0)))
+    second = asyncio.run(flight.run("k", make_render(calls, delay=0)))
+    assert not first.shared and not second.shared
+    assert first.result_dir != second.result_dir and second.meta["render"] == 2
+    # the first result stays on disk for requests that were handed it just before
+    assert os.path.exists(os.path.join(first.result_dir, "out.wav"))
+
+def test_worker_arriving_during_a_render_shares_it_after_it_finishes(tmp_path):
+    calls = []
+    renderer = SingleFlight(str(tmp_path))
+    follower = SingleFlight(str(tmp_path), poll_interval_s=0.01)
+    async def scenario():
+        rendering = asyncio.create_task(renderer.run("k", make_render(calls, delay=0.1)))
+        await asyncio.sleep(0.02)
+        return await asyncio.gather(rendering, follower.run("k", make_render(calls)))
+    rendered, shared = asyncio.run(scenario())
+    assert len(calls) == 1 and shared.shared and shared.result_dir == rendered.result_dir
+
+def test_waiter_on_a_failed_render_does_not_get_the_result_before_it(tmp_path):
+    calls = []
+    earlier = SingleFlight(str(tmp_path))
+    failing = SingleFlight(str(tmp_path))
+    follower = SingleFlight(str(tmp_path), poll_interval_s=0.01)
+    asyncio.run(earlier.run("k", make_render(calls, delay=0)))
+    async def scenario():
+        doomed = asyncio.create_task(failing.run("k", make_render(calls, delay=0.1, fail=True)))
+        await asyncio.sleep(0.02)
+        result = await follower.run("k", make_render(calls, delay=0))
+        with pytest.raises(RuntimeError):
+            await doomed
+        return result
+    result = asyncio.run(scenario())
+    assert not result.shared and result.meta["render"] == 3
+
+def test_expired_results_are_swept(tmp_path):
+    calls = []
+    flight = SingleFlight(str(tmp_path), ttl_s=60)
+    old_result = asyncio.run(flight.run("k", make_render(calls, delay=0))).result_dir
+    current = asyncio.run(flight.run("k", make_render(calls, delay=0))).result_dir
+    old = time.time() - 120
+    os.utime(old_result, (old, old))
+    flight.sweep()
+    assert not os.path.exists(old_result) and os.path.exists(current)
+    for name in os.listdir(tmp_path):
+        os.utime(tmp_path / name, (old, old))
+    flight.sweep()
+    assert os.listdir(tmp_path) == []
+
+def test_waiting_for_another_worker_times_out(tmp_path):
+    blocker = SingleFlight(str(tmp_path))
+    waiter = SingleFlight(str(tmp_path), poll_interval_s=0.01, wait_timeout_s=0.05)
+    async def scenario():
+        slow = asyncio.create_task(blocker.run("k", make_render([], delay=0.3)))
+        await asyncio.sleep(0.02)
+        with pytest.raises(TimeoutError):
+            await waiter.run("k", make_render([]))
+        await slow
+    asyncio.run(scenario())
+
+def test_sweep_leaves_no_lock_file_whatever_the_listing_order(tmp_path, monkeypatch):
+    flight = SingleFlight(str(tmp_path), ttl_s=60)
+    asyncio.run(flight.run("k", make_render([], delay=0)))
+    old = time.time() - 120
+    for name in os.listdir(tmp_path):
+        os.utime(tmp_path / name, (old, old))
+    listdir = os.listdir
+    # the marker first: its lock file is removed before the result directory is checked
+    monkeypatch.setattr(os, "listdir", lambda path: sorted(listdir(path), key=lambda name: not name.endswith(".json")))
+    flight.sweep()
+    monkeypatch.undo()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from pydub.generators import Sine
+
+from sound_combiner import AudioCombiner, StemMix, tile_segments
+
+FRAME_RATE = 44100
+
+def tone(freq, duration_ms, volume=-12.0):
+    return Sine(freq, sample_rate=FRAME_RATE).to_audio_segment(duration=duration_ms, volume=volume)
+
+def as_array(segment):
+    return np.array(segment.get_array_of_samples(), dtype=np.int64)
+
+@pytest.fixture
+def stems():
+    return {"kick": tone(60, 500), "ride": tone(880, 300), "bass": tone(110, 800)}
+
+def test_stems_are_padded_to_longest(stems):
+    mix = StemMix.from_segments(stems)
+    assert mix.names == ["kick", "ride", "bass"]
+    assert mix.samples.shape == (3, int(FRAME_RATE * 0.8))
+    assert mix.duration_ms == 800
+
+def test_unity_remix_is_sum_of_stems(stems):
+    mix = StemMix.from_segments(stems)
+    expected = np.zeros(mix.samples.shape[1], dtype=np.int64)
+    for seg in stems.values():
+        arr = as_array(seg)
+        expected[:len(arr)] += arr
+    assert np.abs(as_array(mix.remix()) - expected).max() <= 1
+
+def test_mute_removes_stem(stems):
+    mix = StemMix.from_segments(stems)
+    only_bass = as_array(mix.remix(mutes={"kick", "ride"}))
+    assert np.array_equal(only_bass, as_array(stems["bass"]))
+
+@pytest.mark.parametrize("gain_db, factor", [(0.0, 1.0), (-6.0, 10 ** (-6 / 20)), (6.0, 10 ** (6 / 20))])
+def test_gain_in_db(stems, gain_db, factor):
+    mix = StemMix.from_segments({"bass": stems["bass"]})
+    remixed = as_array(mix.remix({"bass": gain_db}))
+    assert np.abs(remixed - np.rint(as_array(stems["bass"]) * factor)).max() <= 1
+
+def test_unknown_stem_is_rejected(stems):
+    mix = StemMix.from_segments(stems)
+    with pytest.raises(ValueError):
+        mix.remix({"tuba": 3.0})
+    with pytest.raises(ValueError):
+        mix.remix(mutes={"tuba"})
+
+@pytest.mark.parametrize("gain_db", [1e6, -1e6, float("nan"), float("inf"), 24.5])
+def test_gain_out_of_range_is_rejected(stems, gain_db):
+    mix = StemMix.from_segments(stems)
+    with pytest.raises(ValueError):
+        mix.remix({"bass": gain_db})
+
+def test_save_and_load_roundtrip(stems, tmp_path):
+    mix = StemMix.from_segments(stems)
+    mix.save(str(tmp_path))
+    loaded = StemMix.load(str(tmp_path))
+    assert loaded.names == mix.names
+    assert (loaded.frame_rate, loaded.channels, loaded.sample_width) == (mix.frame_rate, mix.channels, mix.sample_width)
+    assert loaded.remix({"ride": -3.0}, {"kick"}).raw_data == mix.remix({"ride": -3.0}, {"kick"}).raw_data
+
+def test_combiner_keeps_one_track_per_stem(tmp_path):
+    kick_path, bass_path = str(tmp_path / "kick.wav"), str(tmp_path / "bass.wav")
+    tone(60, 100).export(kick_path, format="wav")
+    tone(110, 1000).export(bass_path, format="wav")
+    combiner = AudioCombiner(tempo=120, ts=4)
+    combiner.place_at(kick_path, 0, 0, stem="kick")
+    combiner.place_at(kick_path, 1, 0, stem="kick")
+    combiner.place_at(bass_path, 0, 0, stem="bass")
+    assert set(combiner.stems) == {"kick", "bass"}
+    assert len(combiner.stems["kick"]) == 2100  # second kick starts at bar 2 (2000 ms at 120 bpm)
+    assert len(combiner.main_audio) == 2100
+
+def test_tile_segments_sums_tails_across_offsets():
+    long_tone, short_tone = tone(220, 700), tone(330, 200)
+    tiled = tile_segments([long_tone, None, short_tone], [0, 500, 500])
+    assert len(tiled) == 700
+    expected = np.zeros(len(as_array(tiled)), dtype=np.int64)
+    expected[:len(as_array(long_tone))] += as_array(long_tone)
+    start = int(FRAME_RATE * 0.5)
+    expected[start:start + len(as_array(short_tone))] += as_array(short_tone)
+    assert np.array_equal(as_array(tiled), expected)
+
+def test_tile_segments_empty():
+    assert len(tile_segments([None, None], [0, 100])) == 0
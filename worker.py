@@ -0,0 +1,119 @@
+"""
+Render worker: takes generation jobs from the broker, runs the pipeline and stores the final WAV as an artifact.
+Run any number of them next to the web app started with JAZZCOMP_RENDER_MODE=broker:
+
+    python worker.py [--broker-db PATH] [--artifacts-dir PATH] [--worker-id ID] [--max-jobs N]
+
+All of them must see the same broker database, artifact directory and JAZZCOMP_TEMP_DIR (for the cached stems).
+SQLiteBroker keeps the queue in WAL mode, which SQLite does not support on network filesystems, so app and
+workers must run on one host; spreading workers over several hosts needs another Broker backend.
+"""
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from typing import Callable
+
+import pipeline
+from broker import CANCELLED, ArtifactStore, Broker, FileArtifactStore, SQLiteBroker
+
+BROKER_DB = os.environ.get("JAZZCOMP_BROKER_DB", os.path.join(pipeline.TEMP_BASE_DIR, "jobs.sqlite"))
+ARTIFACTS_DIR = os.environ.get("JAZZCOMP_ARTIFACTS_DIR", os.path.join(pipeline.TEMP_BASE_DIR, "artifacts"))
+WAV_ARTIFACT = "final_composition.wav"
+# workers renew the lease of the job they render every third of it, so only a dead worker's job is handed out again
+JOB_LEASE_S = float(os.environ.get("JAZZCOMP_JOB_LEASE_S", "60"))
+# finished jobs (and artifacts nobody collected) are deleted after JAZZCOMP_JOB_RETENTION_S seconds;
+# keep it above the app's JAZZCOMP_JOB_TIMEOUT_S
+JOB_RETENTION_S = float(os.environ.get("JAZZCOMP_JOB_RETENTION_S", "3600"))
+PURGE_INTERVAL_S = 300.0
+
+def process_job(broker: Broker, store: ArtifactStore, job, render: Callable[[str, str, str, str | None], str]):
+    """Renders one claimed job: payload {"chord_progression", "session_id", "base_session_id"} -> artifact WAV_ARTIFACT."""
+    session_id = job.payload["session_id"]
+    rendered = threading.Event()
+    lease_keeper = threading.Thread(target=_keep_lease, args=(broker, job, rendered), daemon=True)
+    lease_keeper.start()
+    try:
+        with tempfile.TemporaryDirectory(prefix=f"job_{job.id}_", dir=pipeline.TEMP_BASE_DIR) as work_dir:
+            wav_path = render(job.payload["chord_progression"], session_id, work_dir, job.payload.get("base_session_id"))
+            store.put(job.id, WAV_ARTIFACT, wav_path)
+        rendered.set()
+        lease_keeper.join()
+        if not broker.complete(job.id, {"session_id": session_id, "wav": WAV_ARTIFACT}, job.worker_id):
+            _lost_claim(broker, store, job)
+            return
+        print(f"Job {job.id}: Session {session_id} rendered.")
+    except Exception as e:
+        print(f"Job {job.id}: Session {session_id} failed: {e}")
+        traceback.print_exc()
+        if not broker.fail(job.id, f"{type(e).__name__}: {e}", job.worker_id):
+            _lost_claim(broker, store, job)
+    finally:
+        rendered.set()
+
+def _keep_lease(broker: Broker, job, rendered: threading.Event):
+    while not rendered.wait(broker.lease_s / 3):
+        if not broker.renew(job.id, job.worker_id):
+            return  # cancelled or taken over; complete() will tell
+
+def _lost_claim(broker: Broker, store: ArtifactStore, job):
+    current = broker.get(job.id)
+    if current is not None and current.status == CANCELLED:
+        store.delete(job.id)
+        print(f"Job {job.id}: Cancelled while rendering, result discarded.")
+    else:
+        # another worker took the job over after our lease expired; the stored artifact is as good as its own
+        print(f"Job {job.id}: Taken over by worker {current.worker_id if current else '?'}, leaving the result to it.")
+
+def purge_jobs(broker: Broker, store: ArtifactStore, older_than_s: float = JOB_RETENTION_S) -> int:
+    """Deletes old finished jobs together with their artifacts; returns how many were deleted."""
+    job_ids = broker.purge(older_than_s)
+    for job_id in job_ids:
+        store.delete(job_id)
+    return len(job_ids)
+
+def run_worker(broker: Broker, store: ArtifactStore, worker_id: str | None = None, poll_interval_s: float = 0.5,
+               max_jobs: int | None = None, render: Callable[[str, str, str, str | None], str] = pipeline.render_composition,
+               purge_interval_s: float = PURGE_INTERVAL_S, job_retention_s: float = JOB_RETENTION_S) -> int:
+    """
+    Claims and renders jobs until max_jobs are done (forever by default); returns the number of jobs processed.
+    Every purge_interval_s it also deletes jobs finished more than job_retention_s ago, so the queue does not grow forever.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    print(f"Worker {worker_id}: Waiting for jobs.")
+    processed = 0
+    next_purge = time.monotonic()
+    while max_jobs is None or processed < max_jobs:
+        if time.monotonic() >= next_purge:
+            purged = purge_jobs(broker, store, job_retention_s)
+            if purged:
+                print(f"Worker {worker_id}: Purged {purged} finished job(s).")
+            next_purge = time.monotonic() + purge_interval_s
+        job = broker.claim(worker_id)
+        if job is None:
+            time.sleep(poll_interval_s)
+            continue
+        print(f"Worker {worker_id}: Claimed job {job.id} (attempt {job.attempts}).")
+        process_job(broker, store, job, render)
+        processed += 1
+    return processed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render worker for the jazz accompaniment generator.")
+    parser.add_argument("--broker-db", default=BROKER_DB)
+    parser.add_argument("--artifacts-dir", default=ARTIFACTS_DIR)
+    parser.add_argument("--worker-id", default=None)
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--max-jobs", type=int, default=None)
+    args = parser.parse_args(argv)
+    if not pipeline.msc_path:
+        parser.error("MuseScore path not configured (set JAZZCOMP_MUSESCORE or music21's musicxmlPath).")
+    run_worker(SQLiteBroker(args.broker_db, lease_s=JOB_LEASE_S), FileArtifactStore(args.artifacts_dir), args.worker_id,
+               args.poll_interval, args.max_jobs)
+
+if __name__ == "__main__":
+    main()